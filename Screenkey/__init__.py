@@ -49,6 +49,23 @@ BAK_MODES = {
     'full': _('Full'),
 }
 
+LISTENER_MODES = {
+    'thread': _('Thread'),
+    'watch': _('Main loop'),
+    'process': _('Separate process'),
+}
+
+CAPTURE_BACKENDS = {
+    'xrecord': _('XRecord'),
+    'xinput2': _('XInput2 raw events'),
+    'evdev': _('evdev devices'),
+}
+
+KBD_BACKENDS = {
+    'xim': _('X input method'),
+    'xkb': _('libxkbcommon'),
+}
+
 MODS_MODES = {
     'normal': _('Normal'),
     'emacs': _('Emacs'),
@@ -0,0 +1,243 @@
+# Distributed under the GNU GPLv3+ license, WITHOUT ANY WARRANTY.
+#
+# evdev input source.
+#
+# Reads input_event structs straight from /dev/input/event* (which requires
+# read access to the devices, usually through the "input" group), or from a
+# recorded byte stream, for capture outside of X. A trace is simply the raw
+# content of a device node:
+#
+#   cat /dev/input/event3 > trace.bin
+#
+# and can be decoded and translated with:
+#
+#   python3 evdev.py trace.bin
+#   python3 evdev.py --bench 5000000
+
+import errno
+import fcntl
+import glob
+import os
+import struct
+
+
+# struct input_event: timeval, type, code, value
+INPUT_EVENT = struct.Struct('llHHi')
+READ_EVENTS = 64
+
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_REL = 0x02
+
+SYN_DROPPED = 0x03
+
+REL_HWHEEL = 0x06
+REL_WHEEL = 0x08
+
+BTN_MISC = 0x100
+BTN_LEFT = 0x110
+BTN_RIGHT = 0x111
+BTN_MIDDLE = 0x112
+BTN_SIDE = 0x113
+BTN_EXTRA = 0x114
+BTN_JOYSTICK = 0x120
+BTN_DIGI = 0x140
+BTN_WHEEL = 0x150
+BTN_TRIGGER_HAPPY = 0x2c0
+
+KEY_RELEASE = 0
+KEY_PRESS = 1
+KEY_REPEAT = 2
+
+# evdev button codes to X buttons
+BUTTONS = {
+    BTN_LEFT: 1,
+    BTN_MIDDLE: 2,
+    BTN_RIGHT: 3,
+    BTN_SIDE: 8,
+    BTN_EXTRA: 9,
+}
+
+# wheel axes to X buttons (negative, positive)
+WHEELS = {
+    REL_WHEEL: (5, 4),
+    REL_HWHEEL: (6, 7),
+}
+
+# evdev keycodes are offset by 8 in X/xkb
+KEYCODE_OFFSET = 8
+
+
+def is_key(code):
+    # the BTN_* ranges are not translated through the keymap
+    return code < BTN_MISC or BTN_WHEEL + 16 <= code < BTN_TRIGGER_HAPPY
+
+
+def eviocgname(length):
+    return (2 << 30) | (length << 16) | (ord('E') << 8) | 0x06
+
+
+def device_name(fd):
+    buf = bytearray(256)
+    try:
+        length = fcntl.ioctl(fd, eviocgname(len(buf)), buf)
+    except OSError:
+        return None
+    return bytes(buf[:length]).rstrip(b'\0').decode('utf-8', 'replace')
+
+
+
+class EvdevDecoder():
+    # split a byte stream into input events, keeping partial records
+    def __init__(self):
+        self.partial = b''
+
+
+    def feed(self, data):
+        if self.partial:
+            data = self.partial + data
+        end = len(data) - len(data) % INPUT_EVENT.size
+        self.partial = bytes(data[end:])
+        return INPUT_EVENT.iter_unpack(memoryview(data)[:end])
+
+
+
+class EvdevSource():
+    # a set of non-blocking evdev devices or recorded streams
+    def __init__(self, paths=None):
+        if not paths:
+            paths = sorted(glob.glob('/dev/input/event*'))
+        self.fds = {}
+        self.decoders = {}
+        self.devices = {}
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            self.fds[fd] = len(self.fds) + 1
+            self.decoders[fd] = EvdevDecoder()
+            self.devices[self.fds[fd]] = device_name(fd) or path
+        if not self.fds:
+            raise Exception("Cannot open any evdev device")
+
+
+    def fileno_list(self):
+        return list(self.fds)
+
+
+    def device(self, fd):
+        return self.fds[fd]
+
+
+    def read(self, fd):
+        # read everything available from fd in batches; return the decoded
+        # events and whether fd is still open
+        chunks = []
+        size = READ_EVENTS * INPUT_EVENT.size
+        while True:
+            try:
+                data = os.read(fd, size)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.ENODEV:
+                    # device unplugged
+                    self.remove(fd)
+                    return chunks, False
+                raise
+            if not data:
+                # end of a recorded stream
+                chunks.append(self.decoders[fd].feed(data))
+                self.remove(fd)
+                return chunks, False
+            chunks.append(self.decoders[fd].feed(data))
+            if len(data) < size:
+                break
+        return chunks, True
+
+
+    def remove(self, fd):
+        os.close(fd)
+        del self.fds[fd]
+        del self.decoders[fd]
+
+
+    def close(self):
+        for fd in list(self.fds):
+            self.remove(fd)
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import time
+    import xkb
+
+    ap = ArgumentParser(description="decode and translate evdev streams")
+    ap.add_argument('-l', '--layout', default='us', help="layout[:variant]")
+    ap.add_argument('--bench', type=int, metavar='N',
+                    help="decode and translate N synthetic events")
+    ap.add_argument('paths', nargs='*', help="evdev devices or recorded streams")
+    args = ap.parse_args()
+
+    layout, _, variant = args.layout.partition(':')
+    tr = xkb.Translator.from_names(layout, variant or None)
+
+    def translate(events):
+        count = 0
+        for sec, usec, type, code, value in events:
+            if type == EV_KEY and is_key(code):
+                keycode = code + KEYCODE_OFFSET
+                if value != KEY_RELEASE:
+                    tr.translate(keycode)
+                tr.update_key(keycode, value != KEY_RELEASE)
+            count += 1
+        return count
+
+    if args.bench:
+        # press/release/syn triplets over the alphanumeric block
+        pattern = b''
+        for code in range(16, 26):
+            for value in (KEY_PRESS, KEY_RELEASE):
+                pattern += INPUT_EVENT.pack(0, 0, EV_KEY, code, value)
+                pattern += INPUT_EVENT.pack(0, 0, EV_SYN, 0, 0)
+        per_pattern = len(pattern) // INPUT_EVENT.size
+        stream = pattern * (args.bench // per_pattern)
+        chunk = READ_EVENTS * INPUT_EVENT.size
+
+        decoder = EvdevDecoder()
+        stamp = time.monotonic()
+        count = 0
+        for start in range(0, len(stream), chunk):
+            for event in decoder.feed(stream[start:start+chunk]):
+                count += 1
+        elapsed = time.monotonic() - stamp
+        print("decode: {} events, {:.0f} events/s".format(count, count / elapsed))
+
+        decoder = EvdevDecoder()
+        stamp = time.monotonic()
+        count = 0
+        for start in range(0, len(stream), chunk):
+            count += translate(decoder.feed(stream[start:start+chunk]))
+        elapsed = time.monotonic() - stamp
+        print("decode+translate: {} events, {:.0f} events/s".format(count, count / elapsed))
+    else:
+        import select
+        source = EvdevSource(args.paths)
+        while source.fds:
+            r_fds, _, _ = select.select(source.fileno_list(), [], [])
+            for fd in r_fds:
+                chunks, alive = source.read(fd)
+                for events in chunks:
+                    for sec, usec, type, code, value in events:
+                        stamp = sec + usec / 1000000
+                        if type == EV_KEY and is_key(code):
+                            keycode = code + KEYCODE_OFFSET
+                            if value != KEY_RELEASE:
+                                keysym, string, filtered = tr.translate(keycode)
+                                print(stamp, xkb.keysym_name(keysym), repr(string), value)
+                            tr.update_key(keycode, value != KEY_RELEASE)
+                        elif type == EV_KEY and code in BUTTONS:
+                            print(stamp, 'button', BUTTONS[code], value)
+    tr.close()
@@ -34,9 +34,11 @@
 if __name__ == '__main__':
     import xlib
     import keysyms
+    import evdev
 else:
     from . import xlib
     from . import keysyms
+    from . import evdev
 
 import sys
 if sys.version_info.major < 3:
@@ -44,9 +46,13 @@ if sys.version_info.major < 3:
 else:
     from gi.repository import GLib as glib
 
+import os
 import threading
 import warnings
 import select
+import time
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
 
 
 # convenience wrappers
@@ -89,14 +95,16 @@ def record_context(dpy, ev_ranges, dev_ranges):
 
 
 def record_enable(dpy, rec_ctx, callback):
+    # the decoded event is only valid during the callback
+    ev = xlib.XEvent()
+
     def intercept(data):
         if data.category != xlib.XRecordFromServer:
             return
         if data.client_swapped:
             warnings.warn("cannot handle swapped protocol data")
             return
-        ev = xlib.XWireToEvent(dpy, data.data)
-        callback(ev)
+        callback(xlib.XWireToEvent(dpy, data.data, ev))
 
     def intercept_(_, data):
         intercept(data.contents)
@@ -118,10 +126,10 @@ def create_replay_window(dpy):
     return win
 
 
-def phantom_release(dpy, kev):
+def phantom_release(dpy, kev, ev):
+    # ev is a scratch event, reused across calls
     if not xlib.XPending(dpy):
         return False
-    ev = xlib.XEvent()
     xlib.XPeekEvent(dpy, xlib.byref(ev))
     return (ev.type == xlib.KeyPress and \
             ev.xkey.state == kev.state and \
@@ -131,7 +139,7 @@ def phantom_release(dpy, kev):
 
 def keysym_to_unicode(keysym):
     if 0x01000000 <= keysym <= 0x0110FFFF:
-        return unichr(keysym - 0x01000000)
+        return chr(keysym - 0x01000000)
     keydata = keysyms.KEYSYMS.get(keysym)
     if keydata is not None:
         return keydata[0]
@@ -139,10 +147,55 @@ def keysym_to_unicode(keysym):
 
 
 
+MODIFIERS = ['shift', 'caps_lock', 'ctrl', 'alt',
+             'num_lock', 'hyper', 'super', 'alt_gr']
+
+# logical modifier bits, in MODIFIERS order
+MOD_SHIFT     = 1 << 0
+MOD_CAPS_LOCK = 1 << 1
+MOD_CTRL      = 1 << 2
+MOD_ALT       = 1 << 3
+MOD_NUM_LOCK  = 1 << 4
+MOD_HYPER     = 1 << 5
+MOD_SUPER     = 1 << 6
+MOD_ALT_GR    = 1 << 7
+
+MOD_BITS = {name: 1 << i for i, name in enumerate(MODIFIERS)}
+
+
+class Modifiers(Mapping):
+    # read-only {name: bool} view of a modifier bitmask
+    __slots__ = ('mods',)
+
+    def __init__(self, mods):
+        self.mods = mods
+
+
+    def __getitem__(self, name):
+        return bool(self.mods & MOD_BITS[name])
+
+
+    def __iter__(self):
+        return iter(MODIFIERS)
+
+
+    def __len__(self):
+        return len(MODIFIERS)
+
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 class KeyData():
+    __slots__ = ('pressed', 'filtered', 'repeated', 'string', 'keysym',
+                 'status', 'symbol', 'mods_mask', 'mods', 'device', 'count',
+                 'time', 'stamp')
+
     def __init__(self, pressed=None, filtered=None, repeated=None,
                  string=None, keysym=None, status=None, symbol=None,
-                 mods_mask=None, modifiers=None):
+                 mods_mask=None, mods=0, device=None, count=1, time=0,
+                 stamp=None):
         self.pressed = pressed
         self.filtered = filtered
         self.repeated = repeated
@@ -151,13 +204,126 @@ class KeyData():
         self.status = status
         self.symbol = symbol
         self.mods_mask = mods_mask
-        self.modifiers = modifiers
+        # logical modifiers (MOD_* bits)
+        self.mods = mods
+        self.device = device
+        # presses collapsed into this event (auto-repeat)
+        self.count = count
+        # server time (ms) and the matching time.monotonic() stamp
+        self.time = time
+        self.stamp = stamp
+
+
+    @property
+    def modifiers(self):
+        return Modifiers(self.mods)
+
+
+    @modifiers.setter
+    def modifiers(self, modifiers):
+        self.mods = 0
+        for name, state in modifiers.items():
+            if state:
+                self.mods |= MOD_BITS[name]
 
 
 class ButtonData():
-    def __init__(self, btn, pressed):
+    __slots__ = ('btn', 'pressed', 'device', 'time', 'stamp', 'count', 'x', 'y')
+
+    def __init__(self, btn, pressed, device=None, time=0, stamp=None, count=1,
+                 x=None, y=None):
         self.btn = btn
         self.pressed = pressed == xlib.ButtonPress
+        self.device = device
+        self.time = time
+        self.stamp = stamp
+        # wheel notches collapsed into this event
+        self.count = count
+        # root window coordinates, when known
+        self.x = x
+        self.y = y
+
+
+class MotionData():
+    __slots__ = ('x', 'y', 'device', 'time', 'stamp')
+
+    def __init__(self, x, y, device=None, time=0, stamp=None):
+        # root window coordinates
+        self.x = x
+        self.y = y
+        self.device = device
+        self.time = time
+        self.stamp = stamp
+
+
+class PreeditData():
+    __slots__ = ('string', 'caret')
+
+    def __init__(self, string, caret=0):
+        self.string = string
+        self.caret = caret
+
+# keysyms identifying the logical modifiers bound to Mod1..Mod5
+MODIFIER_KEYSYMS = {
+    0xffe9: 'alt',      # Alt_L
+    0xffea: 'alt',      # Alt_R
+    0xffe7: 'alt',      # Meta_L
+    0xffe8: 'alt',      # Meta_R
+    0xff7f: 'num_lock', # Num_Lock
+    0xffed: 'hyper',    # Hyper_L
+    0xffee: 'hyper',    # Hyper_R
+    0xffeb: 'super',    # Super_L
+    0xffec: 'super',    # Super_R
+    0xfe03: 'alt_gr',   # ISO_Level3_Shift
+    0xff7e: 'alt_gr',   # Mode_switch
+}
+
+# traditional assignment, used when the server doesn't tell
+DEFAULT_MODIFIER_MASKS = [
+    ('shift', xlib.ShiftMask),
+    ('caps_lock', xlib.LockMask),
+    ('ctrl', xlib.ControlMask),
+    ('alt', xlib.Mod1Mask),
+    ('num_lock', xlib.Mod2Mask),
+    ('hyper', xlib.Mod3Mask),
+    ('super', xlib.Mod4Mask),
+    ('alt_gr', xlib.Mod5Mask),
+]
+
+
+def modifier_masks(mod_keysyms):
+    # mod_keysyms lists the keysyms of the keys bound to each of Mod1..Mod5,
+    # by mask: the first level of every key comes first, in key order, then
+    # the second level. Each mask is given to a single logical modifier,
+    # named by the first known keysym (several keys often share a mask, as
+    # Super_L and Hyper_L on Mod4)
+    masks = {'shift': xlib.ShiftMask, 'caps_lock': xlib.LockMask,
+             'ctrl': xlib.ControlMask}
+    for mask, keysyms in sorted(mod_keysyms.items()):
+        for keysym in keysyms:
+            name = MODIFIER_KEYSYMS.get(keysym)
+            if name is not None:
+                masks[name] = masks.get(name, 0) | mask
+                break
+    if len(masks) == 3:
+        return DEFAULT_MODIFIER_MASKS
+    return [(name, masks.get(name, 0)) for name in MODIFIERS]
+
+
+def server_modifier_keysyms(dpy):
+    # keysyms of the keys bound to Mod1..Mod5 in the modifier mapping
+    mod_keysyms = {}
+    modmap = xlib.XGetModifierMapping(dpy)
+    keypermod = modmap.contents.max_keypermod
+    for mod in range(3, 8):
+        keycodes = [modmap.contents.modifiermap[mod * keypermod + i]
+                    for i in range(keypermod)]
+        keycodes = [keycode for keycode in keycodes if keycode]
+        if keycodes:
+            mod_keysyms[1 << mod] = [xlib.XkbKeycodeToKeysym(dpy, keycode, 0, level)
+                                     for level in range(2) for keycode in keycodes]
+    xlib.XFreeModifiermap(modmap)
+    return mod_keysyms
 
 
 class InputType:
@@ -167,31 +333,286 @@ class InputType:
     all      = 0b111
 
 
+LOOKUP_BUFSIZE = 64
+XIC_CACHE_SIZE = 16
+QUEUE_SIZE = 256
+QUEUE_POLICIES = ['coalesce', 'drop']
+CLOCK_RESYNC = 2.
+WHEEL_BUTTONS = {4, 5, 6, 7}
+
+# motion decimation: minimum distance (px) and frame length (ms)
+MOTION_MIN_DIST = 4
+MOTION_FRAME = 16
+
+# stats counting events lost or reordered before delivery
+LOSS_STATS = ['dropped', 'lost', 'lost_presses', 'lost_releases', 'reordered']
+KBD_BACKENDS = ['xim', 'xkb']
+CAPTURE_BACKENDS = ['xrecord', 'xinput2', 'evdev']
+
+
+def is_modifier_keysym(keysym):
+    # same as IsModifierKey() from Xutil.h
+    return 0xffe1 <= keysym <= 0xffee or 0xfe01 <= keysym <= 0xfe13 or \
+        keysym in (0xff7e, 0xff7f)
+
+
+def compile_keysyms(names):
+    # keysym names to a set of integer keysyms (unknown names are skipped)
+    keysyms = set()
+    for name in names:
+        keysym = xlib.XStringToKeysym(name.encode())
+        if keysym != xlib.NoSymbol:
+            keysyms.add(keysym)
+    return keysyms
+
+
+def is_coalescible(last, data):
+    # an auto-repeat of the queued tail carries no new information
+    return isinstance(last, KeyData) and isinstance(data, KeyData) and \
+        data.repeated and data.pressed and last.pressed and \
+        data.keysym == last.keysym and data.mods_mask == last.mods_mask
+
+
+class ServerClock():
+    # map X server timestamps (ms, wrapping every ~49 days) onto
+    # time.monotonic(). The offset is the one with the smallest delivery
+    # delay seen so far, as events can only arrive after they happen; it's
+    # taken again when the delay grows past CLOCK_RESYNC (clock drift or
+    # a server reset).
+    def __init__(self):
+        self.last = None
+        self.server = 0
+        self.offset = None
+
+
+    def stamp(self, server_time, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.last is not None:
+            # signed 32bit difference, to step across wraps in both directions
+            delta = ((server_time - self.last + 0x80000000) & 0xffffffff) - 0x80000000
+            self.server += delta
+        self.last = server_time
+        server = self.server / 1000
+        offset = now - server
+        if self.offset is None or offset < self.offset or \
+           offset - self.offset > CLOCK_RESYNC:
+            self.offset = offset
+        return server + self.offset
+
+
+class StreamMonitor():
+    # consistency checks on the recorded stream: the server time should not
+    # go backwards, and each key should alternate between press and release
+    # (auto-repeat is recorded as release/press pairs). Anything else means
+    # events were reordered or lost before reaching us.
+    def __init__(self, stats, keymap=None):
+        self.stats = stats
+        self.time = None
+        self.down = bytearray(256)
+        if keymap is not None:
+            # keys already held when recording started
+            for keycode in range(256):
+                self.down[keycode] = (keymap[keycode // 8] >> (keycode % 8)) & 1
+
+
+    def check(self, ev):
+        if not xlib.KeyPress <= ev.type <= xlib.MotionNotify:
+            return
+        kev = ev.xkey
+        if self.time is not None and (kev.time - self.time) & 0x80000000:
+            self.stats['reordered'] += 1
+        self.time = kev.time
+        if ev.type == xlib.KeyPress:
+            if self.down[kev.keycode]:
+                self.stats['lost_releases'] += 1
+            self.down[kev.keycode] = 1
+        elif ev.type == xlib.KeyRelease:
+            if not self.down[kev.keycode]:
+                self.stats['lost_presses'] += 1
+            self.down[kev.keycode] = 0
+
+
+def coalesce_wheel(events, data):
+    # each wheel notch is a press/release pair: fold it into the pair queued
+    # just before, counting one more notch on the press
+    if len(events) < 2 or not isinstance(data, ButtonData) or \
+       data.btn not in WHEEL_BUTTONS:
+        return False
+    press, release = events[-2], events[-1]
+    if not isinstance(press, ButtonData) or not isinstance(release, ButtonData) or \
+       press.btn != data.btn or release.btn != data.btn or \
+       not press.pressed or release.pressed:
+        return False
+    if data.pressed:
+        press.count += 1
+    else:
+        release.time = data.time
+        release.stamp = data.stamp
+    return True
+
+
+def record_latency(stats, stamp):
+    # latency between the listener wakeup and the delivery
+    latency = int((time.monotonic() - stamp) * 1000000)
+    stats['batches'] += 1
+    stats['latency_us'] += latency
+    if latency > stats['latency_max_us']:
+        stats['latency_max_us'] = latency
+
+
+class EventQueue():
+    def __init__(self, size=QUEUE_SIZE, policy='coalesce', collapse_repeats=False):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("unknown queue policy {}".format(policy))
+        self.size = size
+        self.policy = policy
+        self.collapse_repeats = collapse_repeats
+        self.events = deque()
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+
+    def push(self, data, stamp):
+        # return True when the queue was empty and the consumer needs a wakeup
+        with self.lock:
+            events = self.events
+            if isinstance(data, PreeditData) and events and \
+               isinstance(events[-1], PreeditData):
+                # only the latest preedit state is of any interest
+                events[-1] = data
+                self.coalesced += 1
+                return False
+            if self.collapse_repeats and events and is_coalescible(events[-1], data):
+                # the tail was not delivered yet: just count one more press
+                events[-1].count += 1
+                self.coalesced += 1
+                return False
+            if coalesce_wheel(events, data):
+                # always folded, independently of collapse_repeats: the press
+                # carries the notches in its count
+                self.coalesced += 1
+                return False
+            if len(events) >= self.size:
+                if self.policy == 'coalesce' and is_coalescible(events[-1], data):
+                    events[-1].count += 1
+                    self.coalesced += 1
+                    return False
+                events.popleft()
+                self.dropped += 1
+            events.append(data)
+            self.queued += 1
+            if len(events) == 1:
+                self.stamp = stamp
+                return True
+            return False
+
+
+    def drain(self):
+        # return the queued events along with the wakeup time of the oldest
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+            return events, self.stamp
+
+
 
 class InputListener(threading.Thread):
     def __init__(self, event_callback, input_types=InputType.all,
-                 kbd_compose=True, kbd_translate=True):
+                 kbd_compose=True, kbd_translate=True,
+                 queue_size=QUEUE_SIZE, queue_policy='coalesce',
+                 kbd_backend='xim', capture='xrecord', evdev_paths=None,
+                 ignore=(), collapse_repeats=False):
         super().__init__()
         self.event_callback = event_callback
         self.input_types = input_types
         self.kbd_compose = kbd_compose
         self.kbd_translate = kbd_translate
+        # raw events carry no modifier state: it is tracked by libxkbcommon
+        if capture in ['xinput2', 'evdev']:
+            kbd_backend = 'xkb'
+        self.kbd_backend = kbd_backend
+        self.capture = capture
+        self.evdev_paths = evdev_paths
+        self.devices = {}
+        # without composition there's no need to replay events through XIM:
+        # translate them locally as soon as they're recorded. libxkbcommon
+        # performs composition itself, so it always runs locally.
+        self.kbd_local = not kbd_compose or kbd_backend == 'xkb'
+        # keys which are not worth crossing threads
+        self.ignore = compile_keysyms(ignore)
+        self.queue = EventQueue(queue_size, queue_policy, collapse_repeats)
+        self.stats = Counter()
+        self.clock = ServerClock()
+        self._mtn_last = None
+        self._mtn_pending = None
+        self.wakeup_stamp = None
+        self.wakeup_events = 0
+
+        # preallocated buffers for the hot path
+        self._replay_ev = xlib.XEvent()
+        self._replay_ev_ref = xlib.byref(self._replay_ev)
+        self._peek_ev = xlib.XEvent()
+        self._fwd_ev = xlib.XEvent()
+        self._lookup_buf = xlib.create_string_buffer(LOOKUP_BUFSIZE)
+        self._lookup_keysym = xlib.KeySym()
+        self._lookup_keysym_ref = xlib.byref(self._lookup_keysym)
+        self._lookup_status = xlib.Status()
+        self._lookup_status_ref = xlib.byref(self._lookup_status)
+        self._xi_ev = xlib.XEvent()
+        self._xi_ev_ref = xlib.byref(self._xi_ev)
+        self._xi_cookie_ref = xlib.byref(self._xi_ev.xcookie)
+        self._core_ev = xlib.XEvent()
         self.lock = threading.Lock()
         self.stopped = True
         self.error = None
 
 
+    def get_stats(self):
+        stats = dict(self.stats)
+        if stats.get('batches'):
+            stats['latency_avg_us'] = stats['latency_us'] // stats['batches']
+        if stats.get('wakeups'):
+            events = self.stats['recorded'] + self.stats['replayed']
+            stats['events_per_wakeup'] = round(events / stats['wakeups'], 2)
+        stats['queued'] = self.queue.queued
+        stats['dropped'] = self.queue.dropped
+        stats['coalesced'] = self.queue.coalesced
+        return stats
+
+
     def _event_received(self, ev):
-        if xlib.KeyPress <= ev.type <= xlib.MotionNotify:
+        self.stats['recorded'] += 1
+        self.wakeup_events += 1
+        self.monitor.check(ev)
+        if ev.type == xlib.MotionNotify:
+            # never worth replaying
+            if self.input_types & InputType.movement:
+                self._mtn_process(ev)
+            return
+        if self.kbd_local:
+            if self.input_types & InputType.keyboard:
+                self._kbd_local_process(ev)
+            if self.input_types & InputType.button:
+                self._btn_process(ev)
+        elif xlib.KeyPress <= ev.type <= xlib.MotionNotify:
             xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, ev)
-        elif ev.type in [xlib.FocusIn, xlib.FocusOut]:
-            # Forward the event as a custom message in the same queue instead
-            # of resetting the XIC directly, in order to preserve queued events
-            fwd_ev = xlib.XEvent()
+        elif ev.type == xlib.FocusIn and \
+             ev.xfocus.detail in [xlib.NotifyAncestor, xlib.NotifyInferior,
+                                  xlib.NotifyNonlinear]:
+            # Forward the window gaining focus as a custom message in the same
+            # queue instead of switching the XIC directly, in order to
+            # preserve queued events. Virtual and pointer events only concern
+            # the surrounding windows.
+            fwd_ev = self._fwd_ev
             fwd_ev.type = xlib.ClientMessage
             fwd_ev.xclient.message_type = self.custom_atom
             fwd_ev.xclient.format = 32
             fwd_ev.xclient.data[0] = ev.type
+            fwd_ev.xclient.data[1] = ev.xfocus.window
             xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, fwd_ev)
 
 
@@ -199,8 +620,39 @@ class InputListener(threading.Thread):
         self.event_callback(data)
         return False
 
+
+    def _event_dispatch(self):
+        # deliver everything queued since the last wakeup in a single batch
+        events, stamp = self.queue.drain()
+        if events:
+            record_latency(self.stats, stamp)
+            self.event_callback(events)
+        return False
+
+
+    def _event_failure(self):
+        # cheap wakeup() equivalent for compatibility
+        glib.idle_add(self._event_callback, None)
+
+
+    def _event_wakeup(self):
+        glib.idle_add(self._event_dispatch, priority=glib.PRIORITY_DEFAULT)
+
+
+    def _event_queue(self, data):
+        # a single main loop source is pending as long as the queue is not empty
+        if self.queue.push(data, self.wakeup_stamp):
+            self._event_wakeup()
+
+
     def _event_processed(self, data):
-        
+        # drop what the main thread would discard anyway: modifiers are
+        # always forwarded, as their releases are tracked as well
+        if not is_modifier_keysym(data.keysym) and \
+           (not data.pressed or data.keysym in self.ignore):
+            self.stats['prefiltered'] += 1
+            return
+
         data.symbol = xlib.XKeysymToString(data.keysym)
         # print("_event_processed::data.symbol:: ",data.symbol )
 
@@ -215,92 +667,366 @@ class InputListener(threading.Thread):
            
         if data.string is None:
             data.string = keysym_to_unicode(data.keysym)
-        glib.idle_add(self._event_callback, data)
+        self._event_queue(data)
 
 
     def _event_modifiers(self, kev, data):
-        data.modifiers = modifiers = {}
-        modifiers['shift'] = bool(kev.state & xlib.ShiftMask)
-        modifiers['caps_lock'] = bool(kev.state & xlib.LockMask)
-        modifiers['ctrl'] = bool(kev.state & xlib.ControlMask)
-        modifiers['alt'] = bool(kev.state & xlib.Mod1Mask)
-        modifiers['num_lock'] = bool(kev.state & xlib.Mod2Mask)
-        modifiers['hyper'] = bool(kev.state & xlib.Mod3Mask)
-        modifiers['super'] = bool(kev.state & xlib.Mod4Mask)
-        modifiers['alt_gr'] = bool(kev.state & xlib.Mod5Mask)
+        state = kev.state
+        if self._kbd_mod_bits is None:
+            # the core masks are in MODIFIERS order already
+            data.mods = state & self._kbd_mod_mask
+            return
+        mods = 0
+        for bit, mask in self._kbd_mod_bits:
+            if state & mask:
+                mods |= bit
+        data.mods = mods
 
 
     def _event_keypress(self, kev, data):
-        buf = xlib.create_string_buffer(16)
-        keysym = xlib.KeySym()
-        status = xlib.Status()
-        ret = xlib.Xutf8LookupString(self._kbd_replay_xic, kev, buf, len(buf),
-                                     xlib.byref(keysym), xlib.byref(status))
+        keysym = self._lookup_keysym
+        status = self._lookup_status
+        while True:
+            buf = self._lookup_buf
+            ret = xlib.Xutf8LookupString(self._kbd_replay_xic, kev, buf, len(buf),
+                                         self._lookup_keysym_ref, self._lookup_status_ref)
+            if status.value != xlib.XBufferOverflow:
+                break
+            # long commit: grow the buffer and lookup the same event again
+            self._lookup_buf = xlib.create_string_buffer(ret + 1)
+
         if ret != xlib.NoSymbol:
             if 32 <= keysym.value <= 126:
                 # avoid ctrl sequences, just take the character value
                 data.string = chr(keysym.value)
             else:
+                # the buffer is reused and not NUL-terminated
                 try:
-                    data.string = buf.value.decode('utf-8')
+                    data.string = buf.raw[:ret].decode('utf-8')
                 except UnicodeDecodeError:
                     pass
         data.keysym = keysym.value
         data.status = status.value
 
 
+    def _event_keypress_local(self, kev, data):
+        # Latin-1 output from XLookupString is ignored: the string is
+        # derived from the keysym instead
+        xlib.XLookupString(kev, None, 0, self._lookup_keysym_ref, None)
+        data.keysym = self._lookup_keysym.value
+        data.status = xlib.XLookupKeySym
+
+
+    def _event_keypress_xkb(self, kev, data):
+        # the recorded state is the one before the event, as for core lookups
+        xkb = self._kbd_xkb
+        if self.capture == 'xrecord':
+            xkb.update_mask(kev.state)
+        data.keysym, data.string, data.filtered = xkb.translate(kev.keycode)
+        if data.filtered:
+            data.status = None
+        elif data.string is not None:
+            data.status = xlib.XLookupBoth
+        else:
+            data.status = xlib.XLookupKeySym
+
+
     def _event_lookup(self, kev, data):
-        # this is mostly for debugging: we do not account for group/level
-        data.keysym = xlib.XkbKeycodeToKeysym(kev.display, kev.keycode, 0, 0)
+        if self.kbd_backend == 'xkb':
+            # there might be no display to query
+            data.keysym = self._kbd_xkb.lookup(kev.keycode)
+            return
+
+        # this is mostly for debugging: we do not account for the level,
+        # but honor the group to follow layout switches
+        key = (kev.keycode, (kev.state >> 13) & 3)
+        keysym = self._kbd_keysyms.get(key)
+        if keysym is None:
+            keysym = xlib.XkbKeycodeToKeysym(kev.display, key[0], key[1], 0)
+            if keysym == xlib.NoSymbol and key[1]:
+                # keys with fewer groups wrap to the first one
+                keysym = xlib.XkbKeycodeToKeysym(kev.display, key[0], 0, 0)
+            self._kbd_keysyms[key] = keysym
+        data.keysym = keysym
 
 
     def start(self):
         self.lock.acquire()
         self.stopped = False
         self.error = None
+        # self-pipe used to wake up the event loop on stop()
+        self.stop_rfd, self.stop_wfd = os.pipe()
         super().start()
 
 
     def stop(self):
+        # the X connections are only ever touched by the listener thread
         with self.lock:
             if not self.stopped:
                 self.stopped = True
-                xlib.XRecordDisableContext(self.control_dpy, self.record_ctx)
+                os.write(self.stop_wfd, b'\0')
 
 
     def _kbd_init(self):
-        self._kbd_last_ev = xlib.XEvent()
-
-        if self.kbd_compose:
-            style = xlib.XIMPreeditNothing | xlib.XIMStatusNothing
-        else:
-            style = xlib.XIMPreeditNone | xlib.XIMStatusNone
+        # type, state and keycode of the last keyboard event
+        self._kbd_last_ev = (None, None, None)
+
+        if self.kbd_local:
+            # release held back to detect auto-repeat
+            self._kbd_release_ev = xlib.XEvent()
+            self._kbd_release_device = None
+            self._kbd_release_pending = False
+            if self.kbd_backend == 'xkb':
+                self._kbd_xkb_init()
+            self._kbd_mapping_init()
+            return
 
-        # TODO: implement preedit callbacks for on-the-spot composition
-        #       (this would fix focus-stealing for the global IM state)
         self._kbd_replay_xim = xlib.XOpenIM(self.replay_dpy, None, None, None)
         if not self._kbd_replay_xim:
             raise Exception("Cannot initialize input method")
 
-        self._kbd_replay_xic = xlib.XCreateIC(self._kbd_replay_xim,
-                                              xlib.XNClientWindow, self.replay_win,
-                                              xlib.XNInputStyle, style,
-                                              None)
+        # on-the-spot preedit, when supported by the IM
+        self._kbd_preedit = {}
+        self._kbd_preedit_cbs = None
+        if self.kbd_compose:
+            self._kbd_preedit_init()
+
+        # one XIC per recently focused window (0 until the first focus
+        # change), so that a composition survives switching windows
+        self._kbd_replay_xics = OrderedDict()
+        self._kbd_replay_xic = self._kbd_create_ic()
+        self._kbd_replay_xics[0] = self._kbd_replay_xic
         xlib.XSetICFocus(self._kbd_replay_xic)
+        self._kbd_mapping_init()
+
+
+    def _kbd_preedit_init(self):
+        # the callback objects must outlive all the XICs
+        self._kbd_preedit_procs = [
+            (xlib.XNPreeditStartCallback, xlib.XICProc(self._preedit_start)),
+            (xlib.XNPreeditDoneCallback, xlib.XIMProc(self._preedit_done)),
+            (xlib.XNPreeditDrawCallback, xlib.XIMProc(self._preedit_draw)),
+            (xlib.XNPreeditCaretCallback, xlib.XIMProc(self._preedit_caret))]
+        self._kbd_preedit_cbs = []
+        for name, proc in self._kbd_preedit_procs:
+            cb = xlib.XIMCallback(None, xlib.cast(proc, xlib.c_void_p))
+            self._kbd_preedit_cbs.append((name, cb))
+
+
+    def _kbd_create_ic(self):
+        xic = None
+        unsupported = False
+        if self._kbd_preedit_cbs is not None:
+            args = []
+            for name, cb in self._kbd_preedit_cbs:
+                args.extend([name, xlib.byref(cb)])
+            attrs = xlib.XVaCreateNestedList(0, *args, None)
+            style = xlib.XIMPreeditCallbacks | xlib.XIMStatusNothing
+            xic = xlib.XCreateIC(self._kbd_replay_xim,
+                                 xlib.XNClientWindow, self.replay_win,
+                                 xlib.XNInputStyle, style,
+                                 xlib.XNPreeditAttributes, xlib.c_void_p(attrs),
+                                 None)
+            xlib.XFree(attrs)
+            unsupported = not xic
+
+        if not xic:
+            if self.kbd_compose:
+                style = xlib.XIMPreeditNothing | xlib.XIMStatusNothing
+            else:
+                style = xlib.XIMPreeditNone | xlib.XIMStatusNone
+            xic = xlib.XCreateIC(self._kbd_replay_xim,
+                                 xlib.XNClientWindow, self.replay_win,
+                                 xlib.XNInputStyle, style,
+                                 None)
+        if not xic:
+            raise Exception("Cannot create input context")
+        if unsupported:
+            # callbacks are not supported by the IM: do not try again
+            self._kbd_preedit_cbs = None
+        return xic
+
+
+    def _preedit_update(self, xic, string, caret):
+        # only the focused context is shown
+        self._kbd_preedit[xic] = (string, caret)
+        if xic == xlib.cast(self._kbd_replay_xic, xlib.c_void_p).value:
+            self._event_queue(PreeditData(string, caret))
+
+
+    def _preedit_start(self, xic, client_data, call_data):
+        self._kbd_preedit[xic] = ('', 0)
+        # no length limit
+        return -1
+
+
+    def _preedit_done(self, xic, client_data, call_data):
+        self._preedit_update(xic, '', 0)
+
+
+    def _preedit_draw(self, xic, client_data, call_data):
+        draw = xlib.cast(call_data, xlib.POINTER(xlib.XIMPreeditDrawCallbackStruct)).contents
+        string = self._kbd_preedit.get(xic, ('', 0))[0]
+        text = ''
+        if draw.text:
+            ximtext = draw.text.contents
+            if not ximtext.string:
+                # feedback-only change
+                text = string[draw.chg_first:draw.chg_first + draw.chg_length]
+            elif ximtext.encoding_is_wchar:
+                text = xlib.wstring_at(ximtext.string, ximtext.length)
+            else:
+                text = xlib.string_at(ximtext.string).decode('utf-8', 'replace')
+                text = text[:ximtext.length]
+        string = string[:draw.chg_first] + text + string[draw.chg_first + draw.chg_length:]
+        self._preedit_update(xic, string, draw.caret)
+
+
+    def _preedit_caret(self, xic, client_data, call_data):
+        caret = xlib.cast(call_data, xlib.POINTER(xlib.XIMPreeditCaretCallbackStruct)).contents
+        string = self._kbd_preedit.get(xic, ('', 0))[0]
+        self._kbd_preedit[xic] = (string, caret.position)
+
+
+    def _kbd_focus(self, window):
+        xics = self._kbd_replay_xics
+        xic = xics.get(window)
+        if xic is not None:
+            self.stats['xic_hits'] += 1
+            xics.move_to_end(window)
+        else:
+            self.stats['xic_misses'] += 1
+            try:
+                xic = self._kbd_create_ic()
+            except Exception:
+                # the IM might be restarting: keep the current context, and
+                # just reset it as focus changed
+                self.stats['xic_failures'] += 1
+                self._kbd_reset_ic()
+                return
+            xics[window] = xic
+            if len(xics) > XIC_CACHE_SIZE:
+                # the current XIC is never the least recently used one
+                _, old_xic = xics.popitem(last=False)
+                self._kbd_preedit.pop(xlib.cast(old_xic, xlib.c_void_p).value, None)
+                xlib.XDestroyIC(old_xic)
+                self.stats['xic_evictions'] += 1
+        if xic is not self._kbd_replay_xic:
+            # only the focused context filters events
+            xlib.XUnsetICFocus(self._kbd_replay_xic)
+            xlib.XSetICFocus(xic)
+            old_preedit = self._kbd_preedit.get(
+                xlib.cast(self._kbd_replay_xic, xlib.c_void_p).value, ('', 0))
+            self._kbd_replay_xic = xic
+            preedit = self._kbd_preedit.get(xlib.cast(xic, xlib.c_void_p).value, ('', 0))
+            if preedit != old_preedit:
+                self._event_queue(PreeditData(*preedit))
+
+
+    def _kbd_reset_ic(self):
+        ret = xlib.Xutf8ResetIC(self._kbd_replay_xic)
+        # the pending commit string is of no use
+        if ret: xlib.XFree(ret)
+        key = xlib.cast(self._kbd_replay_xic, xlib.c_void_p).value
+        if self._kbd_preedit.get(key, ('', 0)) != ('', 0):
+            self._kbd_preedit[key] = ('', 0)
+            self._event_queue(PreeditData('', 0))
+
+
+    def _kbd_mapping_init(self):
+        # keymap changes are reported on the replay connection
+        self._kbd_xkb_event = None
+        if self.replay_dpy is not None:
+            opcode, event, error = xlib.c_int(), xlib.c_int(), xlib.c_int()
+            major, minor = xlib.c_int(1), xlib.c_int(0)
+            if xlib.XkbQueryExtension(self.replay_dpy, xlib.byref(opcode), xlib.byref(event),
+                                      xlib.byref(error), xlib.byref(major), xlib.byref(minor)):
+                self._kbd_xkb_event = event.value
+                mask = xlib.XkbNewKeyboardNotifyMask | xlib.XkbMapNotifyMask
+                xlib.XkbSelectEvents(self.replay_dpy, xlib.XkbUseCoreKbd, mask, mask)
+        self._kbd_mapping_refresh()
+
+
+    def _kbd_mapping_refresh(self):
+        # keysyms are looked up lazily per (keycode, group)
+        self._kbd_keysyms = {}
+        if self.kbd_backend == 'xkb':
+            mod_keysyms = self._kbd_xkb.modifier_keysyms()
+        else:
+            mod_keysyms = server_modifier_keysyms(self.replay_dpy)
+        self._kbd_mods = modifier_masks(mod_keysyms)
+        defaults = dict(DEFAULT_MODIFIER_MASKS)
+        if all(mask in (0, defaults[name]) for name, mask in self._kbd_mods):
+            # the usual layouts only leave some modifiers unbound (such as
+            # hyper, which shares Mod4 with super)
+            self._kbd_mod_bits = None
+            self._kbd_mod_mask = 0
+            for name, mask in self._kbd_mods:
+                self._kbd_mod_mask |= mask
+        else:
+            self._kbd_mod_bits = [(MOD_BITS[name], mask) for name, mask in self._kbd_mods if mask]
+
+
+    def _kbd_mapping_notify(self, ev):
+        if ev.type == xlib.MappingNotify:
+            if ev.xmapping.request == xlib.MappingPointer:
+                return
+            xlib.XRefreshKeyboardMapping(ev)
+        elif ev.xkb.xkb_type == xlib.XkbMapNotify:
+            xlib.XkbRefreshKeyboardMapping(ev)
+        elif ev.xkb.xkb_type != xlib.XkbNewKeyboardNotify:
+            return
+
+        self.stats['mapping_changes'] += 1
+        if self.kbd_backend == 'xkb':
+            # reload the keymap (and the current state) from the server
+            self._kbd_xkb.close()
+            self._kbd_xkb_init()
+        self._kbd_mapping_refresh()
+
+
+    def _kbd_xkb_init(self):
+        # libxkbcommon is optional: only load it when requested
+        if __name__ == '__main__':
+            import xkb
+        else:
+            from . import xkb
+
+        locale = None
+        if self.kbd_compose:
+            for var in ['LC_ALL', 'LC_CTYPE', 'LANG']:
+                locale = os.environ.get(var)
+                if locale: break
+            else:
+                locale = 'C'
+
+        # keymap and compose tables are resolved once, in-process
+        if self.capture == 'evdev':
+            # no X connection: the layout comes from the XKB_DEFAULT_* variables
+            self._kbd_xkb = xkb.Translator.from_names(locale=locale)
+        else:
+            self._kbd_xkb = xkb.Translator.from_x11(self.control_dpy, locale)
+        if self.kbd_compose and self._kbd_xkb.compose is None:
+            warnings.warn("no compose table for locale {}".format(locale))
 
 
     def _kbd_del(self):
-        xlib.XDestroyIC(self._kbd_replay_xic)
+        if self.kbd_local:
+            if self.kbd_backend == 'xkb':
+                self._kbd_xkb.close()
+            return
+        for xic in self._kbd_replay_xics.values():
+            xlib.XDestroyIC(xic)
+        self._kbd_replay_xics.clear()
+        self._kbd_preedit.clear()
         xlib.XCloseIM(self._kbd_replay_xim)
 
 
     def _kbd_process(self, ev):
         if ev.type == xlib.ClientMessage and \
            ev.xclient.message_type == self.custom_atom:
-            if ev.xclient.data[0] in [xlib.FocusIn, xlib.FocusOut]:
-                # we do not keep track of multiple XICs, just reset
-                xic = xlib.Xutf8ResetIC(self._kbd_replay_xic)
-                if xic is not None: xlib.XFree(xic)
+            if ev.xclient.data[0] == xlib.FocusIn:
+                self._kbd_focus(ev.xclient.data[1])
             return
         elif ev.type in [xlib.KeyPress, xlib.KeyRelease]:
             # fake keyboard event data for XFilterEvent
@@ -310,67 +1036,161 @@ class InputListener(threading.Thread):
         # pass _all_ events to XFilterEvent
         filtered = bool(xlib.XFilterEvent(ev, 0))
         if ev.type == xlib.KeyRelease and \
-           phantom_release(self.replay_dpy, ev.xkey):
+           phantom_release(self.replay_dpy, ev.xkey, self._peek_ev):
             return
         if ev.type not in [xlib.KeyPress, xlib.KeyRelease]:
             return
+        self._kbd_event(ev, filtered, self._event_keypress)
+
 
+    def _kbd_event(self, ev, filtered, translate, device=None):
         # generate new keyboard event
         data = KeyData()
+        data.device = device
         data.filtered = filtered
         data.pressed = (ev.type == xlib.KeyPress)
-        data.repeated = (ev.type == self._kbd_last_ev.type and \
-                         ev.xkey.state == self._kbd_last_ev.xkey.state and \
-                         ev.xkey.keycode == self._kbd_last_ev.xkey.keycode)
+        last_ev = (ev.type, ev.xkey.state, ev.xkey.keycode)
+        data.repeated = (last_ev == self._kbd_last_ev)
         data.mods_mask = ev.xkey.state
+        data.time = ev.xkey.time
+        data.stamp = self.clock.stamp(data.time)
         self._event_modifiers(ev.xkey, data)
         if not data.filtered and data.pressed and self.kbd_translate:
-            self._event_keypress(ev.xkey, data)
+            translate(ev.xkey, data)
         else:
             self._event_lookup(ev.xkey, data)
         self._event_processed(data)
-        self._kbd_last_ev = ev
+        self._kbd_last_ev = last_ev
 
 
-    def _btn_process(self, ev):
-        if ev.type in [xlib.ButtonPress, xlib.ButtonRelease]:
-            data = ButtonData(ev.xbutton.button, ev.type)
-            glib.idle_add(self._event_callback, data)
+    def _kbd_local_process(self, ev, device=None):
+        if ev.type not in [xlib.KeyPress, xlib.KeyRelease]:
+            # a held release is not a phantom one: keep the event order
+            self._kbd_local_flush()
+            if ev.type in [xlib.FocusIn, xlib.FocusOut]:
+                # a pending sequence cannot continue in another window
+                self._kbd_xkb.reset()
+            return
 
+        # lookups need a connection which is not recording
+        kev = ev.xkey
+        kev.display = self.replay_dpy
+
+        # auto-repeat generates a release/press pair with the same timestamp:
+        # the phantom release is dropped as done by phantom_release()
+        if self._kbd_release_pending:
+            self._kbd_release_pending = False
+            rev = self._kbd_release_ev.xkey
+            if not (ev.type == xlib.KeyPress and kev.state == rev.state and \
+                    kev.keycode == rev.keycode and kev.time == rev.time):
+                self._kbd_event(self._kbd_release_ev, False, None,
+                                self._kbd_release_device)
+        if ev.type == xlib.KeyRelease:
+            xlib.memmove(xlib.addressof(self._kbd_release_ev), xlib.addressof(ev),
+                         xlib.sizeof(xlib.XEvent))
+            self._kbd_release_device = device
+            self._kbd_release_pending = True
+            return
+        if self.kbd_backend == 'xkb':
+            self._kbd_event(ev, False, self._event_keypress_xkb, device)
+        else:
+            self._kbd_event(ev, False, self._event_keypress_local, device)
+
+
+    def _kbd_local_flush(self):
+        # emit a release held back at the end of a batch
+        if self._kbd_release_pending:
+            self._kbd_release_pending = False
+            self._kbd_event(self._kbd_release_ev, False, None,
+                            self._kbd_release_device)
+
+
+    def _btn_process(self, ev, device=None):
+        if ev.type in [xlib.ButtonPress, xlib.ButtonRelease]:
+            data = ButtonData(ev.xbutton.button, ev.type, device, ev.xbutton.time)
+            data.stamp = self.clock.stamp(data.time)
+            if device is None:
+                # recorded events carry the pointer position
+                data.x = ev.xbutton.x_root
+                data.y = ev.xbutton.y_root
+            self._event_queue(data)
+
+
+    def _mtn_process(self, ev):
+        # decimate motion before it leaves the thread: samples closer than
+        # MOTION_MIN_DIST to the last one are skipped, and only the latest
+        # sample of each frame is kept
+        self.stats['motion'] += 1
+        mev = ev.xmotion
+        x, y = mev.x_root, mev.y_root
+        last = self._mtn_last
+        if last is not None:
+            if (x - last.x) ** 2 + (y - last.y) ** 2 < MOTION_MIN_DIST ** 2:
+                return
+            if last is self._mtn_pending and \
+               mev.time // MOTION_FRAME == last.time // MOTION_FRAME:
+                last.x, last.y, last.time = x, y, mev.time
+                return
+        self._mtn_flush()
+        self._mtn_pending = self._mtn_last = MotionData(x, y, None, mev.time)
+
+
+    def _mtn_flush(self):
+        data = self._mtn_pending
+        if data is not None:
+            self._mtn_pending = None
+            data.stamp = self.clock.stamp(data.time)
+            self.stats['motion_queued'] += 1
+            self._event_queue(data)
+
+
+    def _open(self):
+        if self.capture == 'evdev':
+            self._evdev_open()
+            return
 
-    def run(self):
         # control connection
         self.control_dpy = xlib.XOpenDisplay(None)
         xlib.XSynchronize(self.control_dpy, True)
 
-        # unmapped replay window
+        # unmapped replay window (also used for lookups in local mode)
         self.replay_dpy = xlib.XOpenDisplay(None)
         self.custom_atom = xlib.XInternAtom(self.replay_dpy, b"SCREENKEY", False)
-        replay_fd = xlib.XConnectionNumber(self.replay_dpy)
+        self.replay_fd = xlib.XConnectionNumber(self.replay_dpy)
         self.replay_win = create_replay_window(self.replay_dpy)
 
         # bail during initialization errors
         try:
             if self.input_types & InputType.keyboard:
                 self._kbd_init()
-        except Exception as e:
-            self.error = e
+        except Exception:
             xlib.XCloseDisplay(self.control_dpy)
             xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
             xlib.XCloseDisplay(self.replay_dpy)
+            raise
 
-            # cheap wakeup() equivalent for compatibility
-            glib.idle_add(self._event_callback, None)
+        # initialize capture
+        try:
+            if self.capture == 'xinput2':
+                self._xi_open()
+            else:
+                self._record_open()
+        except Exception:
+            if self.input_types & InputType.keyboard:
+                self._kbd_del()
+            xlib.XCloseDisplay(self.control_dpy)
+            xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
+            xlib.XCloseDisplay(self.replay_dpy)
+            raise
 
-            self.stopped = True
-            self.lock.release()
-            return
 
+    def _record_open(self):
         # initialize recording context
         ev_ranges = []
         dev_ranges = []
         if self.input_types & InputType.keyboard:
-            ev_ranges.append([xlib.FocusIn, xlib.FocusOut])
+            if self.kbd_compose:
+                ev_ranges.append([xlib.FocusIn, xlib.FocusOut])
             dev_ranges.append([xlib.KeyPress, xlib.KeyRelease])
         if self.input_types & InputType.button:
             dev_ranges.append([xlib.ButtonPress, xlib.ButtonRelease])
@@ -378,47 +1198,200 @@ class InputListener(threading.Thread):
             dev_ranges.append([xlib.MotionNotify, xlib.MotionNotify])
         self.record_ctx = record_context(self.control_dpy, ev_ranges, dev_ranges);
 
-        record_dpy = xlib.XOpenDisplay(None)
-        record_fd = xlib.XConnectionNumber(record_dpy)
+        keymap = (xlib.c_char * 32)()
+        xlib.XQueryKeymap(self.control_dpy, keymap)
+        self.monitor = StreamMonitor(self.stats, keymap.raw)
+
+        self.record_dpy = xlib.XOpenDisplay(None)
+        self.record_fd = xlib.XConnectionNumber(self.record_dpy)
         # we need to keep the record_ref alive(!)
-        record_ref = record_enable(record_dpy, self.record_ctx, self._event_received)
+        self.record_ref = record_enable(self.record_dpy, self.record_ctx, self._event_received)
 
-        # event loop
-        self.lock.release()
-        while True:
-            with self.lock:
-                if self.stopped:
-                    break
 
-            r_fd = []
-            if xlib.XPending(record_dpy):
-                r_fd.append(record_fd)
-            if xlib.XPending(self.replay_dpy):
-                r_fd.append(replay_fd)
-            if not r_fd:
-                r_fd, _, _ = select.select([record_fd, replay_fd], [], [])
-            if not r_fd:
-                break
+    def _xi_open(self):
+        # raw events are only delivered to the root window, but regardless
+        # of grabs and for every client: use a dedicated connection
+        self.libxi = xlib.load_xi()
+        self.record_dpy = xlib.XOpenDisplay(None)
+        self.record_fd = xlib.XConnectionNumber(self.record_dpy)
+        try:
+            self._xi_select()
+        except Exception:
+            xlib.XCloseDisplay(self.record_dpy)
+            raise
+
+
+    def _xi_select(self):
+        dpy = self.record_dpy
+        opcode, event, error = xlib.c_int(), xlib.c_int(), xlib.c_int()
+        if not xlib.XQueryExtension(dpy, b"XInputExtension", xlib.byref(opcode),
+                                    xlib.byref(event), xlib.byref(error)):
+            raise Exception("XInput extension not available")
+        self.xi_opcode = opcode.value
+
+        # 2.2 is required for the sourceid of raw events
+        major, minor = xlib.c_int(2), xlib.c_int(2)
+        if self.libxi.XIQueryVersion(dpy, xlib.byref(major), xlib.byref(minor)) != 0 or \
+           (major.value, minor.value) < (2, 2):
+            raise Exception("XInput 2.2 not available")
+
+        evtypes = []
+        if self.input_types & InputType.keyboard:
+            evtypes.extend([xlib.XI_RawKeyPress, xlib.XI_RawKeyRelease])
+        if self.input_types & InputType.button:
+            evtypes.extend([xlib.XI_RawButtonPress, xlib.XI_RawButtonRelease])
+        if self.input_types & InputType.movement:
+            evtypes.append(xlib.XI_RawMotion)
+        raw_mask = xlib.XIMask(*evtypes)
+        dev_mask = xlib.XIMask(xlib.XI_HierarchyChanged)
+        masks = (xlib.XIEventMask * 2)(
+            xlib.XIEventMask(xlib.XIAllMasterDevices, len(raw_mask), raw_mask),
+            xlib.XIEventMask(xlib.XIAllDevices, len(dev_mask), dev_mask))
+        root = xlib.XDefaultRootWindow(dpy)
+        self.libxi.XISelectEvents(dpy, root, masks, len(masks))
+
+        # there's no focus event without XRecord: follow the active window
+        self.active_atom = xlib.XInternAtom(dpy, b"_NET_ACTIVE_WINDOW", False)
+        if self.input_types & InputType.keyboard and self.kbd_compose:
+            xlib.XSelectInput(dpy, root, xlib.PropertyChangeMask)
+
+        self._xi_devices()
+        xlib.XFlush(dpy)
+
+
+    def _xi_devices(self):
+        count = xlib.c_int()
+        info = self.libxi.XIQueryDevice(self.record_dpy, xlib.XIAllDevices, xlib.byref(count))
+        devices = {}
+        for i in range(count.value):
+            devices[info[i].deviceid] = info[i].name.decode('utf-8', 'replace')
+        self.libxi.XIFreeDeviceInfo(info)
+        self.devices = devices
+        self._devices_changed()
+
+
+    def _devices_changed(self):
+        pass
 
-            if record_fd in r_fd:
-                xlib.XRecordProcessReplies(record_dpy)
-                xlib.XFlush(self.replay_dpy)
 
-            if replay_fd in r_fd:
-                ev = xlib.XEvent()
-                xlib.XNextEvent(self.replay_dpy, xlib.byref(ev))
-                if self.input_types & InputType.keyboard:
-                    self._kbd_process(ev)
-                if self.input_types & InputType.button:
-                    self._btn_process(ev)
+    def _xi_process(self):
+        dpy = self.record_dpy
+        ev = self._xi_ev
+        xlib.XNextEvent(dpy, self._xi_ev_ref)
+        if ev.type == xlib.PropertyNotify:
+            if ev.xproperty.atom == self.active_atom:
+                self._kbd_xkb.reset()
+            return
 
-        # finalize
-        self.lock.acquire()
+        cookie = ev.xcookie
+        if ev.type != xlib.GenericEvent or cookie.extension != self.xi_opcode or \
+           not xlib.XGetEventData(dpy, self._xi_cookie_ref):
+            return
+        try:
+            if cookie.evtype == xlib.XI_HierarchyChanged:
+                self._xi_devices()
+            else:
+                raw = xlib.cast(cookie.data, xlib.POINTER(xlib.XIRawEvent)).contents
+                self._xi_raw_event(raw)
+        finally:
+            xlib.XFreeEventData(dpy, self._xi_cookie_ref)
+
+
+    def _xi_raw_event(self, raw):
+        evtype = raw.evtype
+        if evtype in [xlib.XI_RawKeyPress, xlib.XI_RawKeyRelease]:
+            self._local_key(raw.detail, evtype == xlib.XI_RawKeyPress,
+                            bool(raw.flags & xlib.XIKeyRepeat), raw.time, raw.sourceid)
+        elif evtype in [xlib.XI_RawButtonPress, xlib.XI_RawButtonRelease]:
+            self._local_button(raw.detail, evtype == xlib.XI_RawButtonPress,
+                               raw.time, raw.sourceid)
+
+
+    def _evdev_open(self):
+        # no X connection at all
+        self.replay_dpy = None
+        self.evdev = evdev.EvdevSource(self.evdev_paths)
+        self.devices = dict(self.evdev.devices)
+        self._devices_changed()
+        try:
+            if self.input_types & InputType.keyboard:
+                self._kbd_init()
+        except Exception:
+            self.evdev.close()
+            raise
+
+
+    def _evdev_process(self, fd):
+        device = self.evdev.device(fd)
+        chunks, alive = self.evdev.read(fd)
+        keyboard = self.input_types & InputType.keyboard
+        button = self.input_types & InputType.button
+        for events in chunks:
+            for sec, usec, type, code, value in events:
+                stamp = (sec * 1000 + usec // 1000) & 0xffffffff
+                if type == evdev.EV_SYN and code == evdev.SYN_DROPPED:
+                    # the kernel buffer overflowed
+                    self.stats['lost'] += 1
+                elif type == evdev.EV_KEY:
+                    if evdev.is_key(code):
+                        if keyboard:
+                            self._local_key(code + evdev.KEYCODE_OFFSET,
+                                            value != evdev.KEY_RELEASE,
+                                            value == evdev.KEY_REPEAT, stamp, device)
+                    elif button and code in evdev.BUTTONS and value != evdev.KEY_REPEAT:
+                        self._local_button(evdev.BUTTONS[code], bool(value), stamp, device)
+                elif type == evdev.EV_REL and button and code in evdev.WHEELS:
+                    # one click per wheel detent
+                    btn = evdev.WHEELS[code][value > 0]
+                    for i in range(abs(value)):
+                        self._local_button(btn, True, stamp, device)
+                        self._local_button(btn, False, stamp, device)
+
+
+    def _local_key(self, keycode, pressed, repeat, time, device):
+        # synthesize the equivalent core event for the local path, using
+        # the modifier state tracked by libxkbcommon
+        self.stats['recorded'] += 1
+        self.wakeup_events += 1
+        ev = self._core_ev
+        kev = ev.xkey
+        ev.type = xlib.KeyPress if pressed else xlib.KeyRelease
+        kev.keycode = keycode
+        kev.time = time
+        kev.state = self._kbd_xkb.mods_mask()
+        # repeats are flagged: there's no phantom release to hold back
+        self._kbd_event(ev, False, self._event_keypress_xkb, device)
+        if not repeat:
+            # repeats would otherwise stack the modifier state
+            self._kbd_xkb.update_key(keycode, pressed)
+
+
+    def _local_button(self, button, pressed, time, device):
+        self.stats['recorded'] += 1
+        self.wakeup_events += 1
+        ev = self._core_ev
+        ev.type = xlib.ButtonPress if pressed else xlib.ButtonRelease
+        ev.xbutton.button = button
+        ev.xbutton.time = time
+        self._btn_process(ev, device)
+
+
+    def _close(self):
+        if self.capture == 'evdev':
+            self.evdev.close()
+            if self.input_types & InputType.keyboard:
+                self._kbd_del()
+            return
 
-        xlib.XRecordFreeContext(self.control_dpy, self.record_ctx)
-        xlib.XCloseDisplay(self.control_dpy)
-        xlib.XCloseDisplay(record_dpy)
-        del record_ref
+        if self.capture == 'xinput2':
+            xlib.XCloseDisplay(self.control_dpy)
+            xlib.XCloseDisplay(self.record_dpy)
+        else:
+            xlib.XRecordDisableContext(self.control_dpy, self.record_ctx)
+            xlib.XRecordFreeContext(self.control_dpy, self.record_ctx)
+            xlib.XCloseDisplay(self.control_dpy)
+            xlib.XCloseDisplay(self.record_dpy)
+            self.record_ref = None
 
         if self.input_types & InputType.keyboard:
             self._kbd_del()
@@ -426,20 +1399,186 @@ class InputListener(threading.Thread):
         xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
         xlib.XCloseDisplay(self.replay_dpy)
 
-        self.stopped = True
+
+    def _process_replay(self):
+        self.stats['replayed'] += 1
+        self.wakeup_events += 1
+        ev = self._replay_ev
+        xlib.XNextEvent(self.replay_dpy, self._replay_ev_ref)
+        if self.input_types & InputType.keyboard and \
+           (ev.type == xlib.MappingNotify or ev.type == self._kbd_xkb_event):
+            self._kbd_mapping_notify(ev)
+            return
+        if self.input_types & InputType.keyboard:
+            self._kbd_process(ev)
+        if self.input_types & InputType.button:
+            self._btn_process(ev)
+
+
+    def _process_pending(self):
+        # drain all connections before sleeping again: all the events
+        # recorded in a single pass are forwarded with a single flush
+        self.wakeup_stamp = time.monotonic()
+        self.wakeup_events = 0
+        if self.capture == 'evdev':
+            for fd in self.evdev.fileno_list():
+                self._evdev_process(fd)
+            if self.input_types & InputType.keyboard:
+                self._kbd_local_flush()
+        else:
+            self._process_display()
+        if self.input_types & InputType.movement:
+            self._mtn_flush()
+
+        self.stats['wakeups'] += 1
+        if self.wakeup_events > self.stats['wakeup_events_max']:
+            self.stats['wakeup_events_max'] = self.wakeup_events
+
+
+    def _process_display(self):
+        while not self.stopped:
+            if self.capture == 'xinput2':
+                while not self.stopped and \
+                      xlib.XEventsQueued(self.record_dpy, xlib.QueuedAfterReading):
+                    self._xi_process()
+            else:
+                xlib.XRecordProcessReplies(self.record_dpy)
+            if self.kbd_local and self.input_types & InputType.keyboard:
+                self._kbd_local_flush()
+            xlib.XFlush(self.replay_dpy)
+            if not xlib.XEventsQueued(self.replay_dpy, xlib.QueuedAfterReading):
+                break
+            while not self.stopped and \
+                  xlib.XEventsQueued(self.replay_dpy, xlib.QueuedAfterReading):
+                self._process_replay()
+
+
+    def _fds(self):
+        if self.capture == 'evdev':
+            return self.evdev.fileno_list()
+        return [self.record_fd, self.replay_fd]
+
+
+    def _pending(self):
+        # events already buffered by Xlib are not visible to select()
+        if self.capture == 'evdev':
+            return False
+        return xlib.XPending(self.record_dpy) or xlib.XPending(self.replay_dpy)
+
+
+    def _close_pipe(self):
+        os.close(self.stop_rfd)
+        os.close(self.stop_wfd)
+
+
+    def run(self):
+        try:
+            self._open()
+        except Exception as e:
+            self.error = e
+            self._event_failure()
+            self.stopped = True
+            self._close_pipe()
+            self.lock.release()
+            return
+
+        # event loop: stopped is only ever set, no locking required
         self.lock.release()
+        while not self.stopped:
+            if not self._pending():
+                # evdev streams are dropped once exhausted
+                r_fd, _, _ = select.select(self._fds() + [self.stop_rfd], [], [])
+                if not r_fd or self.stop_rfd in r_fd:
+                    break
+            self._process_pending()
+
+        # finalize
+        with self.lock:
+            self._close()
+            self.stopped = True
+            self._close_pipe()
+
+
+
+class WatchInputListener(InputListener):
+    # Run the same pipeline on the main context through IO watches on the
+    # record/replay connections: events are translated and delivered inline,
+    # without the extra thread and the hand-off through the main loop.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.watches = {}
+
 
+    def start(self):
+        self.stopped = False
+        self.error = None
+        try:
+            self._open()
+        except Exception as e:
+            self.error = e
+            self.stopped = True
+            self._event_failure()
+            return
+
+        for fd in self._fds():
+            tag = glib.io_add_watch(fd, glib.PRIORITY_DEFAULT, glib.IO_IN,
+                                    self._fd_ready)
+            self.watches[fd] = tag
+
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        for tag in self.watches.values():
+            glib.source_remove(tag)
+        self.watches = {}
+        self._close()
+
+
+    def join(self, timeout=None):
+        pass
+
+
+    def is_alive(self):
+        return not self.stopped
+
+
+    def _event_wakeup(self):
+        # delivered at the end of each watch dispatch
+        pass
+
+
+    def _fd_ready(self, fd, condition):
+        # watches only fire on new data: leave nothing buffered in Xlib
+        self._process_pending()
+        self._event_dispatch()
+
+        # drop the watches of exhausted evdev streams
+        fds = self._fds()
+        for wfd in [x for x in self.watches if x not in fds]:
+            tag = self.watches.pop(wfd)
+            if wfd != fd:
+                glib.source_remove(tag)
+        return fd in fds
 
 
 if __name__ == '__main__':
-    def callback(data):
-        values = {}
-        for k in dir(data):
-            if k[0] == '_': continue
-            values[k] = getattr(data, k)
-        print(values)
-
-    kl = InputListener(callback)
+    def callback(events):
+        if events is None:
+            return
+        for data in events:
+            values = {}
+            for k in dir(data):
+                if k[0] == '_': continue
+                values[k] = getattr(data, k)
+            if data.device is not None:
+                values['device'] = kl.devices.get(data.device, data.device)
+            print(values)
+
+    capture = sys.argv[1] if len(sys.argv) > 1 else 'xrecord'
+    kl = InputListener(callback, capture=capture)
     try:
         # keep running only while the listener is alive
         kl.start()
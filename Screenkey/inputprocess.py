@@ -0,0 +1,331 @@
+# Distributed under the GNU GPLv3+ license, WITHOUT ANY WARRANTY.
+#
+# Out-of-process input listener.
+#
+# The XRecord/XIM pipeline of inputlistener is run in a child process, which
+# writes fixed-size event records into a ring in shared memory. The UI process
+# is woken up through a pipe only when the ring goes from empty to non-empty,
+# and then drains all the pending records at once. Capture then proceeds
+# undisturbed by the GIL contention caused by rendering in the UI process.
+#
+# The ring has a single producer and a single consumer: the producer only
+# writes the head and the drop counter, the consumer only writes the tail.
+# On overflow the newest event is dropped, as the producer cannot reclaim
+# records the consumer might be reading.
+
+from . import xlib
+from .inputlistener import InputListener, InputType, KeyData, ButtonData, \
+    MotionData, PreeditData, QUEUE_SIZE, record_latency
+
+from gi.repository import GLib
+
+import multiprocessing
+import struct
+from collections import Counter
+from multiprocessing import shared_memory
+
+
+# ring layout
+U64 = struct.Struct('=Q')
+HEAD_OFFSET = 0
+TAIL_OFFSET = 8
+DROPPED_OFFSET = 16
+HEADER_SIZE = 24
+
+# kind, flags, string length, modifiers, keysym/button, state, status,
+# wakeup stamp, utf-8 string, device, repeat count, server time, event stamp
+RECORD = struct.Struct('=BBBBIIid64sHHId')
+RECORD_STRLEN = 64
+
+KIND_KEY = 1
+KIND_BUTTON = 2
+KIND_PREEDIT = 3
+KIND_MOTION = 4
+
+FLAG_PRESSED  = 0b0001
+FLAG_FILTERED = 0b0010
+FLAG_REPEATED = 0b0100
+FLAG_STRING   = 0b1000
+FLAG_POSITION = 0b10000
+
+
+class EventRing():
+    def __init__(self, slots, name=None):
+        size = HEADER_SIZE + slots * RECORD.size
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.slots = slots
+        self.buf = self.shm.buf
+
+
+    def dropped(self):
+        return U64.unpack_from(self.buf, DROPPED_OFFSET)[0]
+
+
+    def push(self, record):
+        # return True when the ring was empty and the consumer needs a wakeup
+        buf = self.buf
+        head = U64.unpack_from(buf, HEAD_OFFSET)[0]
+        tail = U64.unpack_from(buf, TAIL_OFFSET)[0]
+        if head - tail >= self.slots:
+            U64.pack_into(buf, DROPPED_OFFSET, self.dropped() + 1)
+            return False
+        offset = HEADER_SIZE + (head % self.slots) * RECORD.size
+        RECORD.pack_into(buf, offset, *record)
+        U64.pack_into(buf, HEAD_OFFSET, head + 1)
+        return head == tail
+
+
+    def pop_all(self):
+        buf = self.buf
+        records = []
+        tail = U64.unpack_from(buf, TAIL_OFFSET)[0]
+        while True:
+            head = U64.unpack_from(buf, HEAD_OFFSET)[0]
+            if head == tail:
+                break
+            while tail != head:
+                offset = HEADER_SIZE + (tail % self.slots) * RECORD.size
+                records.append(RECORD.unpack_from(buf, offset))
+                tail += 1
+            U64.pack_into(buf, TAIL_OFFSET, tail)
+        return records
+
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def encode_event(data, stamp):
+    if isinstance(data, PreeditData):
+        string = data.string.encode('utf-8')[:RECORD_STRLEN]
+        return (KIND_PREEDIT, FLAG_STRING, len(string), 0, data.caret, 0, 0,
+                stamp, string, 0, 0, 0, 0.)
+    if isinstance(data, MotionData):
+        # root coordinates are never negative
+        return (KIND_MOTION, 0, 0, 0, data.x, data.y, 0, stamp, b'',
+                data.device or 0, 0, data.time, data.stamp)
+    if isinstance(data, ButtonData):
+        flags = FLAG_PRESSED if data.pressed else 0
+        x = y = 0
+        if data.x is not None:
+            # root coordinates are never negative
+            flags |= FLAG_POSITION
+            x, y = data.x, data.y
+        return (KIND_BUTTON, flags, 0, 0, data.btn, x, y, stamp, b'',
+                data.device or 0, min(data.count, 0xffff), data.time, data.stamp)
+
+    flags = 0
+    if data.pressed: flags |= FLAG_PRESSED
+    if data.filtered: flags |= FLAG_FILTERED
+    if data.repeated: flags |= FLAG_REPEATED
+    string = b''
+    if data.string is not None:
+        flags |= FLAG_STRING
+        string = data.string.encode('utf-8')[:RECORD_STRLEN]
+    return (KIND_KEY, flags, len(string), data.mods, data.keysym,
+            data.mods_mask, data.status or 0, stamp, string, data.device or 0,
+            min(data.count, 0xffff), data.time, data.stamp)
+
+
+def decode_event(record):
+    kind, flags, strlen, mods, code, state, status, stamp, string, device, count, \
+        server_time, event_stamp = record
+    if kind == KIND_BUTTON:
+        pressed = xlib.ButtonPress if flags & FLAG_PRESSED else xlib.ButtonRelease
+        data = ButtonData(code, pressed, device or None, server_time, event_stamp, count)
+        if flags & FLAG_POSITION:
+            data.x, data.y = state, status
+        return data, stamp
+    if kind == KIND_MOTION:
+        return MotionData(code, state, device or None, server_time, event_stamp), stamp
+    if kind == KIND_PREEDIT:
+        return PreeditData(string[:strlen].decode('utf-8', 'ignore'), code), stamp
+
+    data = KeyData()
+    data.device = device or None
+    data.count = count
+    data.time = server_time
+    data.stamp = event_stamp
+    data.pressed = bool(flags & FLAG_PRESSED)
+    data.filtered = bool(flags & FLAG_FILTERED)
+    data.repeated = bool(flags & FLAG_REPEATED)
+    if flags & FLAG_STRING:
+        # truncation might have split the last character
+        data.string = string[:strlen].decode('utf-8', 'ignore')
+    data.keysym = code
+    data.status = status or None
+    data.symbol = xlib.XKeysymToString(code)
+    data.mods_mask = state
+    data.mods = mods
+    return data, stamp
+
+
+
+class RingInputListener(InputListener):
+    # child side: write events into the ring instead of the main loop queue
+    def __init__(self, conn, ring, *args):
+        super().__init__(None, *args)
+        self.conn = conn
+        self.ring = ring
+
+
+    def _event_queue(self, data):
+        if self.ring.push(encode_event(data, self.wakeup_stamp)):
+            self.conn.send(None)
+
+
+    def _event_failure(self):
+        self.conn.send(('error', str(self.error)))
+
+
+    def _devices_changed(self):
+        self.conn.send(('devices', self.devices))
+
+
+def listener_main(conn, ring_name, slots, args):
+    ring = EventRing(slots, ring_name)
+    try:
+        # the parent owns the segment: do not let our tracker unlink it
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(ring.shm._name, 'shared_memory')
+    except (ImportError, AttributeError):
+        pass
+
+    listener = RingInputListener(conn, ring, *args)
+    listener.start()
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+    listener.stop()
+    listener.join()
+    conn.send(('stats', listener.get_stats()))
+    ring.close()
+
+
+
+class ProcessInputListener():
+    def __init__(self, event_callback, input_types=InputType.all,
+                 kbd_compose=True, kbd_translate=True,
+                 queue_size=QUEUE_SIZE, queue_policy='coalesce',
+                 kbd_backend='xim', capture='xrecord', evdev_paths=None,
+                 ignore=(), collapse_repeats=False):
+        self.event_callback = event_callback
+        self.args = (input_types, kbd_compose, kbd_translate,
+                     queue_size, queue_policy, kbd_backend, capture, evdev_paths,
+                     ignore, collapse_repeats)
+        self.devices = {}
+        self.slots = queue_size
+        self.stats = Counter()
+        self.child_stats = {}
+        self.process = None
+        self.watch = None
+        self.stopping = False
+        self.error = None
+
+
+    def get_stats(self):
+        stats = dict(self.child_stats)
+        stats.update(self.stats)
+        if stats.get('batches'):
+            stats['latency_avg_us'] = stats['latency_us'] // stats['batches']
+        return stats
+
+
+    def start(self):
+        # do not fork the GTK process
+        ctx = multiprocessing.get_context('spawn')
+        self.ring = EventRing(self.slots)
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=listener_main, daemon=True,
+                                   args=(child_conn, self.ring.name,
+                                         self.slots, self.args))
+        self.process.start()
+        child_conn.close()
+        self.watch = GLib.io_add_watch(self.conn.fileno(), GLib.PRIORITY_DEFAULT,
+                                       GLib.IO_IN | GLib.IO_HUP, self._conn_ready)
+
+
+    def stop(self):
+        if self.process is None or self.stopping:
+            return
+        self.stopping = True
+        try:
+            self.conn.send('stop')
+        except OSError:
+            pass
+
+
+    def join(self, timeout=None):
+        if self.process is None:
+            return
+        self.process.join(timeout)
+        if self.watch is not None:
+            GLib.source_remove(self.watch)
+            self.watch = None
+
+        # collect the final stats, leaving any pending event behind
+        self._receive()
+        self.stats['dropped'] = self.ring.dropped()
+        self.conn.close()
+        self.ring.close(unlink=True)
+        self.process = None
+
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+    def _receive(self):
+        # return False once the child is gone
+        try:
+            while self.conn.poll():
+                msg = self.conn.recv()
+                if msg is None:
+                    # plain wakeup
+                    continue
+                kind, value = msg
+                if kind == 'error':
+                    self.error = Exception(value)
+                elif kind == 'stats':
+                    self.child_stats = value
+                elif kind == 'devices':
+                    self.devices = value
+        except (EOFError, OSError):
+            return False
+        return True
+
+
+    def _dispatch(self):
+        records = self.ring.pop_all()
+        if not records:
+            return
+        events = [decode_event(record)[0] for record in records]
+        self.stats['queued'] += len(events)
+        record_latency(self.stats, records[0][7])
+        self.event_callback(events)
+
+
+    def _conn_ready(self, fd, condition):
+        alive = self._receive()
+        if self.error is not None:
+            self.watch = None
+            self.event_callback(None)
+            return False
+
+        self._dispatch()
+        if not alive or condition & GLib.IO_HUP:
+            self.watch = None
+            if not self.stopping:
+                self.error = Exception("input listener process terminated")
+                self.event_callback(None)
+            return False
+        return True
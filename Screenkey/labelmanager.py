@@ -4,12 +4,14 @@
 # Copyright(c) 2019-2020: Yuto Tokunaga <yuntan.sub1@gmail.com>
 
 from . import inputlistener
-from .inputlistener import InputListener, InputType
-
-from gi.repository import GLib
+from . import xlib
+from .inputlistener import InputListener, WatchInputListener, InputType, \
+    MOD_BITS, MOD_SHIFT, MOD_CAPS_LOCK, MOD_CTRL, MOD_ALT, MOD_NUM_LOCK, \
+    MOD_HYPER, MOD_SUPER, MOD_ALT_GR
+from .inputprocess import ProcessInputListener
 
 from collections import namedtuple
-from datetime import datetime
+import time
 
 # Key replacement data:
 #
@@ -21,8 +23,9 @@ from datetime import datetime
 
 ReplData = namedtuple('ReplData', ['value', 'font', 'suffix'])
 KeyRepl  = namedtuple('KeyRepl',  ['bk_stop', 'silent', 'spaced', 'repl'])
-KeyData  = namedtuple('KeyData',  ['stamp', 'is_ctrl', 'bk_stop', 'silent', 'spaced', 'markup'])
-ButtonData = namedtuple('ButtonData',  ['stamp', 'btn', 'pressed'])
+KeyData  = namedtuple('KeyData',  ['stamp', 'is_ctrl', 'bk_stop', 'silent', 'spaced', 'text'])
+ButtonData = namedtuple('ButtonData',  ['stamp', 'btn', 'pressed', 'count', 'x', 'y'],
+                        defaults=[1, None, None])
 
 REPLACE_SYMS = {
     # Regular keys
@@ -180,25 +183,141 @@ REPLACE_MODS = {
 }
 
 
-def keysym_to_mod(keysym):
-    for k, v in MODS_SYMS.items():
-        if keysym in v:
-            return k
-    return None
+def keysym(name):
+    return xlib.XStringToKeysym(name.encode())
+
+
+def compile_keysym_map(table):
+    # keysym names to integer keysyms (unknown names are skipped)
+    ret = {}
+    for name, value in table.items():
+        ks = keysym(name)
+        if ks != xlib.NoSymbol:
+            ret[ks] = value
+    return ret
+
+
+# modifier keysyms to their modifier
+MODS_KEYSYMS = compile_keysym_map({sym: mod for mod, syms in MODS_SYMS.items() for sym in syms})
+
+# modifiers shown in the image, and their button id
+IMAGE_MODS = {'ctrl': 8, 'alt': 9, 'shift': 10}
+
+# lock keys to the modifier reporting their state
+SWITCH_KEYSYMS = compile_keysym_map({'Caps_Lock': MOD_CAPS_LOCK, 'Num_Lock': MOD_NUM_LOCK})
+
+# typing faster than this (or injected through XTest) is summarized
+BURST_INTERVAL = 0.02
+BURST_MIN = 8
+
+# wheel notches closer than this add up to a single scroll
+SCROLL_INTERVAL = 0.5
+
+# modifiers shown as a prefix, in order
+NORMAL_MODS = [(MOD_CTRL, 'ctrl'), (MOD_ALT, 'alt'), (MOD_SUPER, 'super'),
+               (MOD_HYPER, 'hyper')]
+RAW_MODS = [(MOD_SHIFT, 'shift'), (MOD_CTRL, 'ctrl'), (MOD_ALT, 'alt'),
+            (MOD_SUPER, 'super'), (MOD_HYPER, 'hyper'), (MOD_ALT_GR, 'alt_gr')]
+
+# keysym properties
+SYM_MOD        = 1 << 0
+SYM_WHITESPACE = 1 << 1
+SYM_SWITCH     = 1 << 2
+SYM_RETURN     = 1 << 3
+SYM_BACKSPACE  = 1 << 4
+
+
+def compile_sym_flags():
+    flags = {}
+    for flag, names in [(SYM_MOD,        [sym for syms in MODS_SYMS.values() for sym in syms]),
+                        (SYM_WHITESPACE, WHITESPACE_SYMS),
+                        (SYM_SWITCH,     ['Caps_Lock', 'Num_Lock']),
+                        (SYM_RETURN,     ['Return', 'KP_Enter']),
+                        (SYM_BACKSPACE,  ['BackSpace'])]:
+        for ks in inputlistener.compile_keysyms(names):
+            flags[ks] = flags.get(ks, 0) | flag
+    return flags
+
+
+SYM_FLAGS = compile_sym_flags()
+
+
+LISTENERS = {
+    'thread': InputListener,
+    'watch':  WatchInputListener,
+    'process': ProcessInputListener,
+}
+
+
+# label attributes, over (start, end) byte ranges of the label text
+ATTR_FAMILY  = 1    # font family
+ATTR_SYMBOL  = 2    # font family for symbols, in regular weight
+ATTR_COUNT   = 3    # repeat count
+ATTR_RECENT  = 4    # recently typed keys
+ATTR_PREEDIT = 5    # in-progress composition
+
+# attributes of a label update: those of the entries replace the previous
+# ones from byte start onwards (the entries before are unchanged), while the
+# extra ones only apply to this update
+LabelAttrs = namedtuple('LabelAttrs', ['start', 'entries', 'extra'])
+
+
+class Text(str):
+    # plain text, along with the (start, end, family) character ranges to be
+    # shown in a symbol font; concatenation keeps the ranges in place
+    def __new__(cls, value='', fonts=()):
+        self = str.__new__(cls, value)
+        self.fonts = tuple(fonts)
+        return self
+
+
+    def __add__(self, other):
+        if not isinstance(other, str):
+            return NotImplemented
+        fonts = self.fonts
+        if isinstance(other, Text):
+            n = len(self)
+            fonts += tuple((start + n, end + n, font) for start, end, font in other.fonts)
+        return Text(str.__add__(self, other), fonts)
+
+
+    def __radd__(self, other):
+        if not isinstance(other, str):
+            return NotImplemented
+        n = len(other)
+        return Text(other + str(self),
+                    ((start + n, end + n, font) for start, end, font in self.fonts))
+
+
+def text_attrs(text, offset=0):
+    # symbol font ranges of text, in bytes from offset
+    attrs = []
+    for start, end, font in getattr(text, 'fonts', ()):
+        first = offset + len(text[:start].encode())
+        attrs.append((first, first + len(text[start:end].encode()), ATTR_SYMBOL, font))
+    return attrs
 
 
 class LabelManager:
     def __init__(self, label_listener, image_listener, logger, key_mode,
                  bak_mode, mods_mode, mods_only, multiline, vis_shift,
                  vis_space, recent_thr, compr_cnt, ignore, pango_ctx,
-                 enabled):
+                 enabled, listener_mode='thread', kbd_backend='xim',
+                 capture='xrecord', evdev_paths=None, motion_listener=None):
         self.key_mode = key_mode
+        self.listener_mode = listener_mode
+        self.kbd_backend = kbd_backend
+        self.capture = capture
+        self.evdev_paths = evdev_paths
         self.bak_mode = bak_mode
         self.mods_mode = mods_mode
         self.logger = logger
         self.label_listener = label_listener
         self.image_listener = image_listener
+        self.motion_listener = motion_listener
         self.data = []
+        self.segments = []
+        self.segments_text = []
         self.enabled = enabled
         self.mods_only = mods_only
         self.multiline = multiline
@@ -207,6 +326,14 @@ class LabelManager:
         self.recent_thr = recent_thr
         self.compr_cnt = compr_cnt
         self.ignore = ignore
+        self.ignore_keysyms = inputlistener.compile_keysyms(ignore)
+        self.preedit = ''
+        self.burst_count = 0
+        self.burst_stamp = None
+        self.burst_start = 0
+        self.scroll_btn = None
+        self.scroll_count = 0
+        self.scroll_stamp = None
         self.kl = None
         self.font_families = {x.get_name() for x in pango_ctx.list_families()}
         self.update_replacement_map()
@@ -220,136 +347,232 @@ class LabelManager:
         self.stop()
         compose = (self.key_mode == 'composed')
         translate = (self.key_mode in ['composed', 'translated'])
-        self.kl = InputListener(self.event_handler,
-                                InputType.keyboard | InputType.button,
-                                compose, translate)
+        listener = LISTENERS[self.listener_mode]
+        input_types = InputType.keyboard | InputType.button
+        if self.motion_listener is not None:
+            if self.capture == 'xrecord':
+                input_types |= InputType.movement
+            else:
+                # raw and evdev motion is relative: there's no position to show
+                self.logger.warning("Pointer trail requires XRecord capture.")
+        stamp = time.monotonic()
+        self.kl = listener(self.event_handler, input_types,
+                           compose, translate, kbd_backend=self.kbd_backend,
+                           capture=self.capture, evdev_paths=self.evdev_paths,
+                           ignore=self.ignore, collapse_repeats=True)
         self.kl.start()
-        self.logger.debug("Thread started.")
+        self.logger.debug("Thread started ({} mode) in {:.1f}ms.".format(
+            self.listener_mode, (time.monotonic() - stamp) * 1000))
 
 
     def stop(self):
         if self.kl:
+            stamp = time.monotonic()
             self.kl.stop()
-            self.logger.debug("Thread stopped.")
             self.kl.join()
+            self.logger.debug("Thread stopped in {:.1f}ms.".format(
+                (time.monotonic() - stamp) * 1000))
+            stats = self.kl.get_stats()
+            self.logger.debug("Listener stats: {}".format(stats))
+            loss = {k: stats[k] for k in inputlistener.LOSS_STATS if stats.get(k)}
+            if loss:
+                self.logger.warning("Input events lost or reordered: {}".format(loss))
             self.kl = None
 
 
     def clear(self):
         self.data = []
+        self.segments = []
+        self.segments_text = []
+        self.burst_count = 0
+        self.burst_stamp = None
 
 
-    def get_repl_markup(self, repl):
+    def get_repl_text(self, repl):
         if type(repl) != list:
             repl = [repl]
         for c in repl:
             # no replacement data
             if type(c) != ReplData:
-                return GLib.markup_escape_text(c)
+                return c
 
             # plain suffix
             if c.suffix is None:
                 sfx = ''
             else:
-                sfx = GLib.markup_escape_text(c.suffix)
+                sfx = c.suffix
 
             if c.font is None:
                 # regular font
-                return GLib.markup_escape_text(c.value) + sfx;
+                return c.value + sfx
             elif c.font in self.font_families:
                 # custom symbol
-                return '<span font_family="' + c.font + '" font_weight="regular">' + \
-                    GLib.markup_escape_text(c.value) + '</span>' + sfx;
+                return Text(c.value, [(0, len(c.value), c.font)]) + sfx
 
 
     def update_replacement_map(self):
         self.replace_syms = {}
         for k, v in REPLACE_SYMS.items():
-            markup = self.get_repl_markup(v.repl)
-            self.replace_syms[k] = KeyRepl(v.bk_stop, v.silent, v.spaced, markup)
+            text = self.get_repl_text(v.repl)
+            self.replace_syms[k] = KeyRepl(v.bk_stop, v.silent, v.spaced, text)
+        self.replace_keysyms = compile_keysym_map(self.replace_syms)
 
         self.replace_mods = {}
         for k, v in REPLACE_MODS.items():
             data = v.get(self.mods_mode, v['normal'])
-            self.replace_mods[k] = self.get_repl_markup(data)
+            self.replace_mods[k] = self.get_repl_text(data)
+
+
+    def render_key(self, i, repeats, offset):
+        # render the i-th entry at the given byte offset, given the count of
+        # repeats before it; return its text and size, where the recent
+        # underline can start (if at all), its attributes and the updated count
+        data = self.data
+        key = data[i]
+        text = ''
+        attrs = []
+        if i != 0:
+            last = data[i - 1]
+
+            # compress repeats
+            if self.compr_cnt and key.text == last.text:
+                repeats += 1
+                if repeats < self.compr_cnt:
+                    pass
+                elif i == len(data) - 1 or key.text != data[i + 1].text:
+                    text = '…{}×'.format(repeats + 1)
+                    size = len(text.encode())
+                    attrs.append((offset, offset + size, ATTR_COUNT, None))
+                    if len(key.text) and key.text[-1] == '\n':
+                        text += '\n'
+                        size += 1
+                    return text, size, offset, attrs, repeats
+                else:
+                    return '', 0, None, attrs, repeats
+
+            # character block spacing
+            if len(last.text) and last.text[-1] == '\n':
+                pass
+            elif key.is_ctrl or last.is_ctrl or key.spaced or last.spaced:
+                text = ' '
+            elif key.bk_stop or last.bk_stop or repeats > self.compr_cnt:
+                text = '\u2009'
+                attrs.append((offset, offset + len(text.encode()), ATTR_FAMILY, 'sans'))
+            if key.text != last.text:
+                repeats = 0
+
+        # disable ligatures
+        if len(key.text) == 1 and 0x0300 <= ord(key.text) <= 0x036F:
+            # workaround for pango not handling ZWNJ correctly for combining marks
+            head = text + '\u180e'
+            body = key.text + '\u200a'
+        elif len(key.text):
+            head = text + '\u200c'
+            body = key.text
+        else:
+            size = len(text.encode())
+            return text, size, offset + size, attrs, repeats
+        recent = offset + len(head.encode())
+        attrs += text_attrs(body, recent)
+        text = head + body
+        return text, recent - offset + len(body.encode()), recent, attrs, repeats
 
 
     def update_text(self, synthetic=False):
-        markup = ""
-        recent = False
-        stamp = datetime.now()
-        repeats = 0
-        for i, key in enumerate(self.data):
-            if i != 0:
-                last = self.data[i - 1]
-
-                # compress repeats
-                if self.compr_cnt and key.markup == last.markup:
-                    repeats += 1
-                    if repeats < self.compr_cnt:
-                        pass
-                    elif i == len(self.data) - 1 or key.markup != self.data[i + 1].markup:
-                        if not recent and (stamp - key.stamp).total_seconds() < self.recent_thr:
-                            markup += '<u>'
-                            recent = True
-                        markup += '<sub><small>…{}×</small></sub>'.format(repeats + 1)
-                        if len(key.markup) and key.markup[-1] == '\n':
-                            markup += '\n'
-                        continue
-                    else:
-                        continue
-
-                # character block spacing
-                if len(last.markup) and last.markup[-1] == '\n':
-                    pass
-                elif key.is_ctrl or last.is_ctrl or key.spaced or last.spaced:
-                    markup += ' '
-                elif key.bk_stop or last.bk_stop or repeats > self.compr_cnt:
-                    markup += '<span font_family="sans">\u2009</span>'
-                if key.markup != last.markup:
-                    repeats = 0
-
-            key_markup = key.markup
-            if type(key_markup) is bytes:
-                key_markup = key_markup.decode()
-            if not recent and (stamp - key.stamp).total_seconds() < self.recent_thr:
-                recent = True
-                key_markup = '<u>' + key_markup
-
-            # disable ligatures
-            if len(key.markup) == 1 and 0x0300 <= ord(key.markup) <= 0x036F:
-                # workaround for pango not handling ZWNJ correctly for combining marks
-                markup += '\u180e' + key_markup + '\u200a'
-            elif len(key_markup):
-                markup += '\u200c' + key_markup
-
-        if len(markup) and markup[-1] == '\n':
-            markup = markup.rstrip('\n')
-            if not self.vis_space and not self.data[-1].is_ctrl:
+        # entries are only ever appended or removed at the end: re-render
+        # from the first one which changed, along with the one before it, as
+        # its compression depends on what follows
+        data = self.data
+        segments = self.segments
+        segments_text = self.segments_text
+        i = min(len(data), len(segments))
+        while i and segments[i - 1][0] is not data[i - 1]:
+            i -= 1
+        i = max(i - 1, 0)
+        del segments[i:]
+        del segments_text[i:]
+        if segments:
+            _, repeats, size, _ = segments[-1]
+        else:
+            repeats = size = 0
+        start = size
+        entries = []
+        for i in range(i, len(data)):
+            text, length, recent, attrs, repeats = self.render_key(i, repeats, size)
+            segments.append((data[i], repeats, size + length, recent))
+            segments_text.append(text)
+            entries.extend(attrs)
+            size += length
+
+        # underline from the first entry typed recently; stamps are in order,
+        # so look back only as far as needed
+        stamp = time.monotonic()
+        recent = None
+        for i in range(len(segments) - 1, -1, -1):
+            if segments[i][3] is None:
+                continue
+            if stamp - segments[i][0].stamp >= self.recent_thr:
+                break
+            recent = segments[i][3]
+
+        text = ''.join(segments_text)
+        attrs = []
+        if len(text) and text[-1] == '\n':
+            stripped = text.rstrip('\n')
+            size -= len(text) - len(stripped)
+            text = stripped
+            if not self.vis_space and not data[-1].is_ctrl:
                 # always show some return symbol at the last line
-                markup += self.replace_syms['Return'].repl
-        if recent:
-            markup += '</u>'
-        self.logger.debug("Label updated: %s." % repr(markup))
-        self.label_listener(markup, synthetic)
+                symbol = self.replace_syms['Return'].repl
+                attrs += text_attrs(symbol, size)
+                text += symbol
+                size += len(symbol.encode())
+        if recent is not None:
+            attrs.append((recent, size, ATTR_RECENT, None))
+        if self.preedit:
+            # in-progress composition
+            text += '\u200c'
+            size += len('\u200c'.encode())
+            attrs.append((size, size + len(self.preedit.encode()), ATTR_PREEDIT, None))
+            text += self.preedit
+        self.logger.debug("Label updated: %r.", text)
+        self.label_listener(text, LabelAttrs(start, entries, attrs), synthetic)
 
 
     def queue_update(self):
         self.update_text(True)
 
 
-    def event_handler(self, event):
-        if event is None:
+    def event_handler(self, events):
+        if events is None:
             self.logger.debug("inputlistener failure: {}".format(str(self.kl.error)))
-            self.label_listener(None, None)
+            self.label_listener(None, None, None)
             return
 
-        if isinstance(event, inputlistener.KeyData):
-            self.key_press(event)
-        elif isinstance(event, inputlistener.ButtonData):
-            self.btn_press(event)
-        else:
-            self.logger.error("unhandled event type {}".format(type(event)))
+        # process the whole batch, but render only once
+        update = False
+        for event in events:
+            if isinstance(event, inputlistener.KeyData):
+                update |= bool(self.key_press(event))
+            elif isinstance(event, inputlistener.ButtonData):
+                update |= bool(self.btn_press(event))
+            elif isinstance(event, inputlistener.PreeditData):
+                update |= bool(self.preedit_changed(event))
+            elif isinstance(event, inputlistener.MotionData):
+                if self.enabled and self.motion_listener is not None:
+                    self.motion_listener(event)
+            else:
+                self.logger.error("unhandled event type {}".format(type(event)))
+        if update:
+            self.update_text()
+
+
+    def preedit_changed(self, event):
+        if not self.enabled or event.string == self.preedit:
+            return False
+        self.logger.debug("Preedit changed: {}".format(repr(event.string)))
+        self.preedit = event.string
+        return True
 
 
     def key_press(self, event):
@@ -359,18 +582,17 @@ class LabelManager:
             # and KeyData doesn't contain enough info.
             return
         symbol = event.symbol.decode()
+        sym_mod = MODS_KEYSYMS.get(event.keysym)
 
-        if self.enabled:
-            for mod, button_id in zip(['ctrl', 'alt', 'shift'], range(8, 11)):
-                if symbol in MODS_SYMS[mod]:
-                    self.image_listener(ButtonData(
-                        datetime.now(), button_id, event.pressed
-                    ))
+        if self.enabled and sym_mod in IMAGE_MODS:
+            self.image_listener(ButtonData(
+                event.stamp, IMAGE_MODS[sym_mod], event.pressed
+            ))
 
         if event.pressed == False:
             self.logger.debug("Key released {:5}(ks): {}".format(event.keysym, symbol))
             return
-        if symbol in self.ignore:
+        if event.keysym in self.ignore_keysyms:
             self.logger.debug("Key ignored  {:5}(ks): {}".format(event.keysym, symbol))
             return
         if event.filtered:
@@ -382,48 +604,85 @@ class LabelManager:
                               (state, event.keysym, string, symbol, event.mods_mask))
 
         # Stealth enable/disable handling
-        for mod in ['shift', 'ctrl', 'alt']:
-            if not event.repeated and event.modifiers[mod] \
-               and symbol in MODS_SYMS[mod]:
-                self.enabled = not self.enabled
-                state = 'enabled' if self.enabled else 'disabled'
-                if not self.enabled:
-                    self.image_listener(None)
-                self.logger.info("{mod}+{mod} detected: screenkey {state}".format(
-                    mod=mod.capitalize(), state=state))
+        if sym_mod in IMAGE_MODS and not event.repeated and event.mods & MOD_BITS[sym_mod]:
+            self.enabled = not self.enabled
+            state = 'enabled' if self.enabled else 'disabled'
+            if not self.enabled:
+                self.image_listener(None)
+            self.logger.info("{mod}+{mod} detected: screenkey {state}".format(
+                mod=sym_mod.capitalize(), state=state))
         if not self.enabled:
             return False
 
         # keep the window alive as the user is composing
-        mod_pressed = keysym_to_mod(symbol) is not None
-        update = len(self.data) and (event.filtered or mod_pressed)
+        update = len(self.data) and (event.filtered or sym_mod is not None)
 
         if not event.filtered:
+            flags = SYM_FLAGS.get(event.keysym, 0)
+            if sym_mod is None and self.key_burst(event, flags):
+                return True
             if self.key_mode in ['translated', 'composed']:
-                update |= self.key_normal_mode(event)
+                handler = self.key_normal_mode
             elif self.key_mode == 'raw':
-                update |= self.key_raw_mode(event)
+                handler = self.key_raw_mode
             else:
-                update |= self.key_keysyms_mode(event)
-        if update:
-            self.update_text()
+                handler = self.key_keysyms_mode
+            # auto-repeats can be collapsed by the listener
+            for i in range(event.count):
+                update |= handler(event, symbol, flags)
+        return update
+
+
+    def is_synthetic(self, event):
+        # XInput2 reports the XTest device the events were injected from
+        name = self.kl.devices.get(event.device) if self.kl else None
+        return name is not None and 'XTEST' in name
+
+
+    def key_burst(self, event, flags):
+        # fold a run of fast or injected typing into a single summary entry
+        # (such as a paste through xdotool), returning True when folded
+        typed = self.key_mode in ['translated', 'composed'] and \
+            not self.mods_only and not event.repeated and \
+            not event.mods & (MOD_CTRL | MOD_ALT | MOD_SUPER | MOD_HYPER) and \
+            ((event.string and event.string.isprintable()) or flags & SYM_WHITESPACE)
+        if not typed:
+            self.burst_count = 0
+            self.burst_stamp = None
+            return False
+
+        fast = self.burst_stamp is not None and \
+            event.stamp - self.burst_stamp < BURST_INTERVAL
+        if not (fast or self.is_synthetic(event)) or self.burst_start > len(self.data):
+            # a new run starts with this key
+            self.burst_count = 0
+            self.burst_start = len(self.data)
+        self.burst_stamp = event.stamp
+        self.burst_count += event.count
+        if self.burst_count < BURST_MIN:
+            return False
+
+        # replace the entries of the run with the summary
+        del self.data[self.burst_start:]
+        text = _('«typed {} chars»').format(self.burst_count)
+        self.data.append(KeyData(event.stamp, False, True, True, True, text))
+        return True
 
 
-    def key_normal_mode(self, event):
+    def key_normal_mode(self, event, symbol, flags):
         self.logger.debug("key_normal_mode")
         # Visible modifiers
         mod = ''
-        for cap in ['ctrl', 'alt', 'super', 'hyper']:
-            if event.modifiers[cap]:
+        for bit, cap in NORMAL_MODS:
+            if event.mods & bit:
                 mod = mod + self.replace_mods[cap]
 
         # Backspace handling
-        symbol = event.symbol.decode()
-        if symbol == 'BackSpace' and not self.mods_only and \
-           mod == '' and not event.modifiers['shift']:
-            key_repl = self.replace_syms.get(symbol)
+        if flags & SYM_BACKSPACE and not self.mods_only and \
+           mod == '' and not event.mods & MOD_SHIFT:
+            key_repl = self.replace_keysyms[event.keysym]
             if self.bak_mode == 'normal':
-                self.data.append(KeyData(datetime.now(), False, *key_repl))
+                self.data.append(KeyData(event.stamp, False, *key_repl))
                 return True
             else:
                 if not len(self.data):
@@ -439,21 +698,20 @@ class LabelManager:
                 if pop:
                     self.data.pop()
                 else:
-                    self.data.append(KeyData(datetime.now(), False, *key_repl))
+                    self.data.append(KeyData(event.stamp, False, *key_repl))
                 return True
 
         # Regular keys
-        key_repl = self.replace_syms.get(symbol)
+        key_repl = self.replace_keysyms.get(event.keysym)
         replaced = key_repl is not None
         if key_repl is None:
-            if keysym_to_mod(symbol):
+            if flags & SYM_MOD:
                 return False
             else:
                 repl = event.string or symbol
-                markup = GLib.markup_escape_text(repl)
-                key_repl = KeyRepl(False, False, len(repl) > 1, markup)
+                key_repl = KeyRepl(False, False, len(repl) > 1, repl)
 
-        if event.modifiers['shift'] and \
+        if event.mods & MOD_SHIFT and \
            (replaced or (mod != '' and \
                          self.vis_shift and \
                          self.mods_mode != 'emacs')):
@@ -461,8 +719,8 @@ class LabelManager:
             mod = mod + self.replace_mods['shift']
 
         # Whitespace handling
-        if not self.vis_space and mod == '' and symbol in WHITESPACE_SYMS:
-            if symbol not in ['Return', 'KP_Enter']:
+        if not self.vis_space and mod == '' and flags & SYM_WHITESPACE:
+            if not flags & SYM_RETURN:
                 repl = event.string
             elif self.multiline:
                 repl = ''
@@ -471,7 +729,7 @@ class LabelManager:
             key_repl = KeyRepl(key_repl.bk_stop, key_repl.silent, key_repl.spaced, repl)
 
         # Multiline
-        if symbol in ['Return', 'KP_Enter'] and self.multiline == True:
+        if flags & SYM_RETURN and self.multiline == True:
             key_repl = KeyRepl(key_repl.bk_stop, key_repl.silent,
                                key_repl.spaced, key_repl.repl + '\n')
 
@@ -480,11 +738,11 @@ class LabelManager:
                 repl = key_repl.repl
 
                 # switches
-                if symbol in ['Caps_Lock', 'Num_Lock']:
-                    state = event.modifiers[symbol.lower()]
+                if flags & SYM_SWITCH:
+                    state = event.mods & SWITCH_KEYSYMS[event.keysym]
                     repl += '(%s)' % (_('off') if state else _('on'))
 
-                self.data.append(KeyData(datetime.now(), False, key_repl.bk_stop,
+                self.data.append(KeyData(event.stamp, False, key_repl.bk_stop,
                                          key_repl.silent, key_repl.spaced, repl))
                 return True
         else:
@@ -492,58 +750,55 @@ class LabelManager:
                 repl = mod + key_repl.repl
             else:
                 repl = mod + '‟' + key_repl.repl + '”'
-            self.data.append(KeyData(datetime.now(), True, key_repl.bk_stop,
+            self.data.append(KeyData(event.stamp, True, key_repl.bk_stop,
                                      key_repl.silent, key_repl.spaced, repl))
             return True
 
         return False
 
 
-    def key_raw_mode(self, event):
+    def key_raw_mode(self, event, symbol, flags):
         # modifiers
         mod = ''
-        for cap in REPLACE_MODS.keys():
-            if event.modifiers[cap]:
+        for bit, cap in RAW_MODS:
+            if event.mods & bit:
                 mod = mod + self.replace_mods[cap]
 
         # keycaps
-        symbol = event.symbol.decode()
-        key_repl = self.replace_syms.get(symbol)
+        key_repl = self.replace_keysyms.get(event.keysym)
         if key_repl is None:
-            if keysym_to_mod(symbol):
+            if flags & SYM_MOD:
                 return False
             else:
                 repl = event.string.upper() if event.string else symbol
-                markup = GLib.markup_escape_text(repl)
-                key_repl = KeyRepl(False, False, len(repl) > 1, markup)
+                key_repl = KeyRepl(False, False, len(repl) > 1, repl)
 
         if mod == '':
             repl = key_repl.repl
 
             # switches
-            if symbol in ['Caps_Lock', 'Num_Lock']:
-                state = event.modifiers[symbol.lower()]
+            if flags & SYM_SWITCH:
+                state = event.mods & SWITCH_KEYSYMS[event.keysym]
                 repl += '(%s)' % (_('off') if state else _('on'))
 
-            self.data.append(KeyData(datetime.now(), False, key_repl.bk_stop,
+            self.data.append(KeyData(event.stamp, False, key_repl.bk_stop,
                                      key_repl.silent, key_repl.spaced, repl))
         else:
             if self.mods_mode == 'emacs' or key_repl.repl[0] != mod[-1]:
                 repl = mod + key_repl.repl
             else:
                 repl = mod + '‟' + key_repl.repl + '”'
-            self.data.append(KeyData(datetime.now(), True, key_repl.bk_stop,
+            self.data.append(KeyData(event.stamp, True, key_repl.bk_stop,
                                      key_repl.silent, key_repl.spaced, repl))
         return True
 
 
-    def key_keysyms_mode(self, event):
-        symbol = event.symbol.decode()
-        if symbol in REPLACE_SYMS:
+    def key_keysyms_mode(self, event, symbol, flags):
+        if event.keysym in self.replace_keysyms:
             value = symbol
         else:
             value = event.string or symbol
-        self.data.append(KeyData(datetime.now(), True, True, True, True, value))
+        self.data.append(KeyData(event.stamp, True, True, True, True, value))
         return True
 
     # callback for mouse button presses
@@ -565,14 +820,28 @@ class LabelManager:
                 return False
             # what we refer to as "Mouse 4" has an internal value of 8,
             # so we subtract 4 from the btn value
-            markup = GLib.markup_escape_text("M{}".format(event.btn - 4))
+            text = "M{}".format(event.btn - 4)
 
             # show as label, treated the same as keyboard button presses
-            self.data.append(KeyData(datetime.now(), False, True,
-                         True, True, markup))
-            self.update_text()
+            self.data.append(KeyData(event.stamp, False, True,
+                         True, True, text))
+            return True
         else:
+            # wheel notches are counted per direction
+            count = 1
+            if event.btn in inputlistener.WHEEL_BUTTONS:
+                if event.pressed:
+                    if event.btn == self.scroll_btn and \
+                       event.stamp - self.scroll_stamp < SCROLL_INTERVAL:
+                        self.scroll_count += event.count
+                    else:
+                        self.scroll_btn = event.btn
+                        self.scroll_count = event.count
+                    self.scroll_stamp = event.stamp
+                if event.btn == self.scroll_btn:
+                    count = self.scroll_count
+
             # show event in image
             self.image_listener(
-                ButtonData(datetime.now(), event.btn, event.pressed)
+                ButtonData(event.stamp, event.btn, event.pressed, count, event.x, event.y)
             )
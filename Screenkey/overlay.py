@@ -0,0 +1,178 @@
+# "screenkey" is distributed under GNU GPLv3+, WITHOUT ANY WARRANTY.
+#
+# Pointer overlay: a transparent, click-through window covering the whole
+# screen, on which the pointer trail and click ripples are drawn. Samples are
+# already decimated by the listener, and are kept in a fixed-size ring;
+# ripples use a fixed pool of slots. Animation is driven by the frame clock,
+# each frame strokes the trail as a single path and only repaints the area
+# it covers, so the cost is bounded regardless of the pointer speed or the
+# click rate.
+
+from gi.repository import Gtk, Gdk
+import cairo
+
+from collections import deque
+import math
+import time
+
+
+TRAIL_POINTS = 64               # Samples kept in the trail
+TRAIL_DURATION = 0.5            # Persistence of each sample (s)
+TRAIL_WIDTH = 4                 # Line width (px)
+TRAIL_ALPHA = 0.6               # Opacity of the newest segment
+
+RIPPLE_SLOTS = 8                # Ripples shown at once
+RIPPLE_DURATION = 0.4           # Ripple animation length (s)
+RIPPLE_RADIUS = 32              # Final ripple radius (px)
+RIPPLE_WIDTH = 3                # Ring width (px)
+RIPPLE_ALPHA = 0.8              # Initial ripple opacity
+
+
+class PointerOverlay(Gtk.Window):
+    def __init__(self, color):
+        Gtk.Window.__init__(self, Gtk.WindowType.POPUP)
+        self.set_app_paintable(True)
+        self.set_accept_focus(False)
+        self.set_focus_on_map(False)
+        self.set_keep_above(True)
+
+        scr = self.get_screen()
+        visual = scr.get_rgba_visual()
+        if visual is not None:
+            self.set_visual(visual)
+        self.move(0, 0)
+        self.resize(scr.get_width(), scr.get_height())
+        scr.connect("size-changed", self.on_screen_size_changed)
+
+        self.connect("configure-event", self.on_configure)
+        self.connect("draw", self.on_draw)
+
+        self.color = Gdk.color_parse(color)
+        self.trail = deque(maxlen=TRAIL_POINTS)
+        # each slot is either None or [x, y, stamp]
+        self.ripples = [None] * RIPPLE_SLOTS
+        self.tick_id = None
+        self.damage = []
+
+
+    @staticmethod
+    def available(screen=None):
+        # without a compositor the window would just be opaque
+        if screen is None:
+            screen = Gdk.Screen.get_default()
+        return screen.is_composited() and screen.get_rgba_visual() is not None
+
+
+    def destroy(self):
+        if self.tick_id is not None:
+            self.remove_tick_callback(self.tick_id)
+            self.tick_id = None
+        Gtk.Window.destroy(self)
+
+
+    def set_color(self, color):
+        self.color = Gdk.color_parse(color)
+
+
+    def on_configure(self, widget, event):
+        # let all input through
+        self.input_shape_combine_region(cairo.Region(cairo.RectangleInt(0, 0, 0, 0)))
+
+
+    def on_screen_size_changed(self, screen):
+        self.resize(screen.get_width(), screen.get_height())
+
+
+    def animate(self):
+        if self.tick_id is None:
+            self.tick_id = self.add_tick_callback(self.on_tick)
+
+
+    def add_point(self, x, y, stamp):
+        self.trail.append((x, y, stamp))
+        self.animate()
+
+
+    def add_ripple(self, x, y, stamp):
+        # reuse a free slot, or the oldest ripple
+        index = 0
+        for i, ripple in enumerate(self.ripples):
+            if ripple is None:
+                index = i
+                break
+            if ripple[2] < self.ripples[index][2]:
+                index = i
+        self.ripples[index] = [x, y, stamp]
+        self.animate()
+
+
+    def trail_bounds(self):
+        xs = [p[0] for p in self.trail]
+        ys = [p[1] for p in self.trail]
+        pad = TRAIL_WIDTH
+        return (min(xs) - pad, min(ys) - pad,
+                max(xs) - min(xs) + 2 * pad, max(ys) - min(ys) + 2 * pad)
+
+
+    def on_tick(self, widget, frame_clock):
+        # expire old samples and ripples, then repaint what was and what is
+        # now covered
+        stamp = time.monotonic()
+        while self.trail and stamp - self.trail[0][2] >= TRAIL_DURATION:
+            self.trail.popleft()
+        areas = []
+        if self.trail:
+            areas.append(self.trail_bounds())
+        pad = RIPPLE_RADIUS + RIPPLE_WIDTH
+        for i, ripple in enumerate(self.ripples):
+            if ripple is None:
+                continue
+            if stamp - ripple[2] >= RIPPLE_DURATION:
+                self.ripples[i] = None
+            else:
+                areas.append((ripple[0] - pad, ripple[1] - pad, 2 * pad, 2 * pad))
+        for area in self.damage + areas:
+            self.queue_draw_area(*area)
+        self.damage = areas
+        if not areas:
+            self.tick_id = None
+            return False
+        return True
+
+
+    def on_draw(self, widget, cr):
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        cr.set_source_rgba(0, 0, 0, 0)
+        cr.paint()
+        cr.set_operator(cairo.OPERATOR_OVER)
+        stamp = time.monotonic()
+        red = self.color.red_float
+        green = self.color.green_float
+        blue = self.color.blue_float
+
+        if len(self.trail) > 1:
+            # fade the whole trail along with its newest sample
+            age = stamp - self.trail[-1][2]
+            alpha = TRAIL_ALPHA * max(0, 1 - age / TRAIL_DURATION)
+            cr.set_source_rgba(red, green, blue, alpha)
+            cr.set_line_width(TRAIL_WIDTH)
+            cr.set_line_cap(cairo.LINE_CAP_ROUND)
+            cr.set_line_join(cairo.LINE_JOIN_ROUND)
+            points = iter(self.trail)
+            x, y, _ = next(points)
+            cr.move_to(x, y)
+            for x, y, _ in points:
+                cr.line_to(x, y)
+            cr.stroke()
+
+        cr.set_line_width(RIPPLE_WIDTH)
+        for ripple in self.ripples:
+            if ripple is None:
+                continue
+            x, y, start = ripple
+            progress = min(1, max(0, (stamp - start) / RIPPLE_DURATION))
+            cr.set_source_rgba(red, green, blue, RIPPLE_ALPHA * (1 - progress))
+            cr.new_sub_path()
+            cr.arc(x, y, RIPPLE_RADIUS * (0.25 + 0.75 * progress), 0, 2 * math.pi)
+            cr.stroke()
+        return False
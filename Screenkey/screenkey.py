@@ -4,13 +4,14 @@
 # Copyright(c) 2019-2020: Yuto Tokunaga <yuntan.sub1@gmail.com>
 
 from . import *
-from .labelmanager import LabelManager
+from .labelmanager import LabelManager, LabelAttrs, ATTR_FAMILY, ATTR_SYMBOL, \
+    ATTR_COUNT, ATTR_RECENT, ATTR_PREEDIT
 
-from datetime import datetime
 import json
 import os
 import subprocess
 import numbers
+import time
 from tempfile import NamedTemporaryFile
 
 import gi
@@ -20,6 +21,8 @@ gi.require_version('Pango', '1.0')
 from gi.repository import GLib, Gtk, Gdk, GdkPixbuf, Pango, GObject
 import cairo
 
+from .overlay import PointerOverlay
+
 
 # Gtk shortcuts
 START = Gtk.Align.START
@@ -37,6 +40,9 @@ IF_VALID = Gtk.SpinButtonUpdatePolicy.IF_VALID
 
 BUTTONS_MIN_BLINK = 1/30        # Minimum persistence for any action (s)
 BUTTONS_REL_BRIGHT = 127        # Residual brightness after button release
+BUTTONS_FRAME = 1000 // 30      # Animation frame interval (ms)
+
+LABEL_ATTRS_END = (1 << 31) - 1 # Past any label attribute (bytes)
 
 
 # SVG Data for mouse buttons
@@ -74,6 +80,28 @@ def load_button_pixbufs(color):
     return button_pixbufs
 
 
+def insert_label_attrs(attr_list, attrs):
+    # label attributes as pango attributes, skipping the markup parser
+    for start, end, kind, value in attrs:
+        if kind == ATTR_FAMILY:
+            pango_attrs = [Pango.attr_family_new(value)]
+        elif kind == ATTR_SYMBOL:
+            pango_attrs = [Pango.attr_family_new(value),
+                           Pango.attr_weight_new(Pango.Weight.NORMAL)]
+        elif kind == ATTR_COUNT:
+            # same as <sub><small>
+            pango_attrs = [Pango.attr_rise_new(-5000),
+                           Pango.attr_scale_new(Pango.SCALE_SMALL ** 2)]
+        elif kind == ATTR_RECENT:
+            pango_attrs = [Pango.attr_underline_new(Pango.Underline.SINGLE)]
+        elif kind == ATTR_PREEDIT:
+            pango_attrs = [Pango.attr_underline_new(Pango.Underline.DOUBLE)]
+        for attr in pango_attrs:
+            attr.start_index = start
+            attr.end_index = end
+            attr_list.insert(attr)
+
+
 def gi_module_available(module, version):
     try:
         gi.require_version(module, version)
@@ -117,7 +145,13 @@ class Screenkey(Gtk.Window):
                             'screen': 0,
                             'start_disabled': False,
                             'mouse': False,
-                            'button_hide_duration': 1})
+                            'button_hide_duration': 1,
+                            'mouse_trail': False,
+                            'mouse_ripple': False,
+                            'listener_mode': 'thread',
+                            'kbd_backend': 'xim',
+                            'capture': 'xrecord',
+                            'evdev_paths': None})
         self.options = self.load_state()
         if self.options is None:
             self.options = defaults
@@ -148,19 +182,25 @@ class Screenkey(Gtk.Window):
         self.button_states = [None] * 11
         self.img = Gtk.Image()
         self.update_image_tag = None
+        self.scroll_label = Gtk.Label()
+        self.scroll_count = 0
 
         self.box = Gtk.HBox(homogeneous=False)
         self.box.show()
         self.add(self.box)
 
         self.label = Gtk.Label()
+        self.label_attrs = LabelAttrs(0, [], [])
+        self.label_entry_attrs = Pango.AttrList()
         self.label.set_ellipsize(Pango.EllipsizeMode.START)
         self.label.set_justify(Gtk.Justification.CENTER)
         self.label.show()
 
         self.font = Pango.FontDescription(self.options.font_desc)
+        self.overlay = None
         self.update_colors()
         self.update_mouse_enabled()
+        self.update_overlay()
 
         self.set_size_request(0, 0)
         self.set_gravity(Gdk.Gravity.CENTER)
@@ -177,6 +217,7 @@ class Screenkey(Gtk.Window):
             self.set_visual(visual)
 
         self.box.pack_start(self.img, expand=False, fill=True, padding=0)
+        self.box.pack_start(self.scroll_label, expand=False, fill=True, padding=0)
         self.box.pack_end(self.label, expand=True, fill=True, padding=0)
 
         self.labelmngr = None
@@ -255,14 +296,29 @@ class Screenkey(Gtk.Window):
                     Gdk.color_parse(self.options.font_color)
                 )
             self.img.show()
-            self.update_image_tag = GLib.idle_add(self.update_image)
+            self.queue_update_image()
         else:
             self.img.hide()
+            self.scroll_label.hide()
+            self.scroll_count = 0
             if self.update_image_tag is not None:
                 GLib.source_remove(self.update_image_tag)
                 self.update_image_tag = None
 
 
+    def update_overlay(self):
+        enabled = self.options.mouse_trail or self.options.mouse_ripple
+        if enabled and self.overlay is None:
+            if not PointerOverlay.available(self.get_screen()):
+                self.logger.warning("Pointer overlay requires a compositing manager.")
+                return
+            self.overlay = PointerOverlay(self.options.font_color)
+            self.overlay.show()
+        elif not enabled and self.overlay is not None:
+            self.overlay.destroy()
+            self.overlay = None
+
+
     def do_get_preferred_height(self):
         return self.height
 
@@ -275,11 +331,37 @@ class Screenkey(Gtk.Window):
         self.font.set_absolute_size((20 * self.height // lines // 100) * 1000)
         self.label.set_padding(self.width // 100, 0)
         self.label.get_pango_context().set_font_description(self.font)
+        self.scroll_label.get_pango_context().set_font_description(self.font)
 
         # Moving the text to buttom of screen so it is not distacting
         self.label.set_valign(Gtk.Align.END)
 
 
+    def queue_update_image(self):
+        # the first frame is drawn as soon as possible, then the animation
+        # runs at a fixed frame rate, however many events arrive
+        if not self.update_image_tag:
+            self.update_image_tag = GLib.idle_add(self.update_image_first)
+
+
+    def update_image_first(self):
+        self.update_image_tag = None
+        if self.update_image():
+            self.update_image_tag = GLib.timeout_add(BUTTONS_FRAME, self.update_image)
+        return False
+
+
+    def update_scroll_count(self, count):
+        if count == self.scroll_count:
+            return
+        self.scroll_count = count
+        if count > 1:
+            self.scroll_label.set_text('×{}'.format(count))
+            self.scroll_label.show()
+        else:
+            self.scroll_label.hide()
+
+
     def update_image(self):
         if not self.button_pixbufs:
             self.update_image_tag = None
@@ -287,11 +369,12 @@ class Screenkey(Gtk.Window):
 
         pixbuf = self.button_pixbufs[0]
         copied = False
+        scroll_count = 0
 
         for index, button_state in enumerate(self.button_states):
             if button_state is None:
                 continue
-            delta_time = (datetime.now() - button_state.stamp).total_seconds()
+            delta_time = time.monotonic() - button_state.stamp
             if button_state.pressed or delta_time < BUTTONS_MIN_BLINK:
                 alpha = 255
             elif self.options.button_hide_duration > 0:
@@ -303,6 +386,8 @@ class Screenkey(Gtk.Window):
             if not copied:
                 pixbuf = pixbuf.copy()
                 copied = True
+            if button_state.btn in (4, 5, 6, 7):
+                scroll_count = max(scroll_count, button_state.count)
             self.button_pixbufs[button_state.btn].composite(
                 pixbuf, 0, 0, pixbuf.get_width(), pixbuf.get_height(),
                 0, 0, 1, 1,
@@ -317,6 +402,7 @@ class Screenkey(Gtk.Window):
             width = int(pixbuf.get_width() * scale)
             pixbuf = pixbuf.scale_simple(width, self.height, GdkPixbuf.InterpType.BILINEAR)
         self.img.set_from_pixbuf(pixbuf)
+        self.update_scroll_count(scroll_count)
 
         if not copied:
             self.update_image_tag = None
@@ -327,9 +413,12 @@ class Screenkey(Gtk.Window):
     def update_colors(self):
         font_color = Gdk.color_parse(self.options.font_color)
         self.label.modify_fg(Gtk.StateFlags.NORMAL, font_color)
+        self.scroll_label.modify_fg(Gtk.StateFlags.NORMAL, font_color)
         self.bg_color = Gdk.color_parse(self.options.bg_color)
         if self.options.mouse and self.button_pixbufs:
             self.button_pixbufs = load_button_pixbufs(font_color)
+        if self.overlay is not None:
+            self.overlay.set_color(self.options.font_color)
         self.queue_draw()
 
 
@@ -448,14 +537,20 @@ class Screenkey(Gtk.Window):
                 self.timer_hide = GObject.timeout_add(self.options.timeout * 1000, self.on_timeout_main)
 
 
-    def on_label_change(self, markup, synthetic):
-        if markup is None:
+    def on_label_change(self, text, attrs, synthetic):
+        if text is None:
             self.on_labelmngr_error()
             return
 
-        _, attr, text, _ = Pango.parse_markup(markup, -1, '\0')
         self.label.set_text(text)
-        self.label.set_attributes(attr)
+        # the attributes of the entries are kept across changes: drop and
+        # rebuild only those of the entries which were rendered again
+        self.label_entry_attrs.update(attrs.start, LABEL_ATTRS_END, 0)
+        insert_label_attrs(self.label_entry_attrs, attrs.entries)
+        attr_list = self.label_entry_attrs.copy()
+        insert_label_attrs(attr_list, attrs.extra)
+        self.label.set_attributes(attr_list)
+        self.label_attrs = attrs
         self.update_font()
 
         self.timed_show()
@@ -469,22 +564,28 @@ class Screenkey(Gtk.Window):
     def on_image_change(self, button_state):
         if button_state:
             btn = button_state.btn
+            if self.options.mouse_ripple and self.overlay is not None and \
+               btn in (1, 2, 3) and button_state.pressed and button_state.x is not None:
+                self.overlay.add_ripple(button_state.x, button_state.y, button_state.stamp)
             # Don't do animation after stealth enable
             if self.button_states[btn] is not None or button_state.pressed:
                 self.button_states[btn] = button_state
                 if self.options.mouse:
-                    if not self.update_image_tag:
-                        self.update_image_tag = GLib.idle_add(self.update_image)
+                    self.queue_update_image()
                     self.timed_show()
         else:
             # Reset all
             self.button_states = [None for _ in self.button_states]
             if self.options.mouse:
-                if not self.update_image_tag:
-                    self.update_image_tag = GLib.idle_add(self.update_image)
+                self.queue_update_image()
                 self.timed_show()
 
 
+    def on_motion(self, event):
+        if self.overlay is not None:
+            self.overlay.add_point(event.x, event.y, event.stamp)
+
+
     def on_timeout_main(self):
         if not self.options.persist:
             self.hide()
@@ -504,6 +605,7 @@ class Screenkey(Gtk.Window):
         self.logger.debug("Restarting LabelManager.")
         if self.labelmngr:
             self.labelmngr.stop()
+        motion_listener = self.on_motion if self.options.mouse_trail else None
         self.labelmngr = LabelManager(self.on_label_change,
                                       self.on_image_change,
                                       logger=self.logger,
@@ -518,7 +620,12 @@ class Screenkey(Gtk.Window):
                                       compr_cnt=self.options.compr_cnt,
                                       ignore=self.options.ignore,
                                       pango_ctx=self.label.get_pango_context(),
-                                      enabled=not self.options.start_disabled)
+                                      enabled=not self.options.start_disabled,
+                                      listener_mode=self.options.listener_mode,
+                                      kbd_backend=self.options.kbd_backend,
+                                      capture=self.options.capture,
+                                      evdev_paths=self.options.evdev_paths,
+                                      motion_listener=motion_listener)
         self.labelmngr.start()
 
 
@@ -619,7 +726,7 @@ class Screenkey(Gtk.Window):
             if not self.get_property('visible'):
                 self.show()
             else:
-                self.on_label_change(self.label.get_text(), True)
+                self.on_label_change(self.label.get_text(), self.label_attrs, True)
             self.logger.debug("Persistent changed: %s." % self.options.persist)
 
         def on_sb_compr_changed(widget, data=None):
@@ -697,6 +804,17 @@ class Screenkey(Gtk.Window):
             self.logger.debug("Mouse changed: %s." % self.options.mouse)
             self.update_mouse_enabled()
 
+        def on_cbox_mouse_trail_changed(widget, data=None):
+            self.options.mouse_trail = widget.get_active()
+            self.update_overlay()
+            self.on_change_mode()
+            self.logger.debug("Pointer trail changed: %s." % self.options.mouse_trail)
+
+        def on_cbox_mouse_ripple_changed(widget, data=None):
+            self.options.mouse_ripple = widget.get_active()
+            self.update_overlay()
+            self.logger.debug("Click ripple changed: %s." % self.options.mouse_ripple)
+
         def on_sb_mouse_duration_changed(widget, data=None):
             self.options.button_hide_duration = widget.get_value()
             self.logger.debug("Button hide duration value changed: %f." % self.options.button_hide_duration)
@@ -946,6 +1064,16 @@ class Screenkey(Gtk.Window):
         hbox_mouse.pack_start(lbl_mouse2, expand=False, fill=False, padding=4)
         vbox_mouse.pack_start(hbox_mouse, expand=False, fill=False, padding=6)
 
+        chk_mouse_trail = Gtk.CheckButton(_("Show pointer trail"))
+        chk_mouse_trail.connect("toggled", on_cbox_mouse_trail_changed)
+        chk_mouse_trail.set_active(self.options.mouse_trail)
+        vbox_mouse.pack_start(chk_mouse_trail, expand=False, fill=True, padding=0)
+
+        chk_mouse_ripple = Gtk.CheckButton(_("Show click ripples"))
+        chk_mouse_ripple.connect("toggled", on_cbox_mouse_ripple_changed)
+        chk_mouse_ripple.set_active(self.options.mouse_ripple)
+        vbox_mouse.pack_start(chk_mouse_ripple, expand=False, fill=True, padding=0)
+
         frm_mouse.add(vbox_mouse)
         frm_mouse.show_all()
 
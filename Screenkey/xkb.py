@@ -0,0 +1,430 @@
+# Distributed under the GNU GPLv3+ license, WITHOUT ANY WARRANTY.
+#
+# libxkbcommon bindings, along with an in-process keyboard translator.
+#
+# Translator performs keysym lookup, modifier state tracking and dead
+# key/Compose sequence handling without any input method or X round-trip.
+# Keymaps can be loaded from the server, from RMLVO names or from a keymap
+# file, which allows to exercise the translation without any X server:
+#
+#   python3 xkb.py -l de:nodeadkeys 38 +50 56 -50
+#
+# (keycodes are X keycodes, +/- only press/release the key).
+
+from ctypes import *
+
+libxkbcommon = CDLL('libxkbcommon.so.0')
+
+# types
+xkb_keycode_t = c_uint32
+xkb_keysym_t = c_uint32
+xkb_layout_index_t = c_uint32
+xkb_level_index_t = c_uint32
+xkb_mod_mask_t = c_uint32
+
+class xkb_context(Structure):
+    pass
+
+class xkb_keymap(Structure):
+    pass
+
+class xkb_state(Structure):
+    pass
+
+class xkb_compose_table(Structure):
+    pass
+
+class xkb_compose_state(Structure):
+    pass
+
+class xkb_rule_names(Structure):
+    _fields_ = [('rules', c_char_p),
+                ('model', c_char_p),
+                ('layout', c_char_p),
+                ('variant', c_char_p),
+                ('options', c_char_p)]
+
+
+# constants
+XKB_KEYMAP_FORMAT_TEXT_V1 = 1
+XKB_COMPOSE_FORMAT_TEXT_V1 = 1
+
+XKB_KEY_UP = 0
+XKB_KEY_DOWN = 1
+
+XKB_STATE_MODS_EFFECTIVE = (1<<3)
+XKB_STATE_LAYOUT_EFFECTIVE = (1<<7)
+
+XKB_COMPOSE_FEED_IGNORED = 0
+XKB_COMPOSE_FEED_ACCEPTED = 1
+
+XKB_COMPOSE_NOTHING = 0
+XKB_COMPOSE_COMPOSING = 1
+XKB_COMPOSE_COMPOSED = 2
+XKB_COMPOSE_CANCELLED = 3
+
+
+# functions
+xkb_context_new = libxkbcommon.xkb_context_new
+xkb_context_new.argtypes = [c_int]
+xkb_context_new.restype = POINTER(xkb_context)
+
+xkb_context_unref = libxkbcommon.xkb_context_unref
+xkb_context_unref.argtypes = [POINTER(xkb_context)]
+xkb_context_unref.restype = None
+
+xkb_keymap_new_from_names = libxkbcommon.xkb_keymap_new_from_names
+xkb_keymap_new_from_names.argtypes = [POINTER(xkb_context), POINTER(xkb_rule_names), c_int]
+xkb_keymap_new_from_names.restype = POINTER(xkb_keymap)
+
+xkb_keymap_new_from_string = libxkbcommon.xkb_keymap_new_from_string
+xkb_keymap_new_from_string.argtypes = [POINTER(xkb_context), c_char_p, c_int, c_int]
+xkb_keymap_new_from_string.restype = POINTER(xkb_keymap)
+
+xkb_keymap_unref = libxkbcommon.xkb_keymap_unref
+xkb_keymap_unref.argtypes = [POINTER(xkb_keymap)]
+xkb_keymap_unref.restype = None
+
+xkb_keymap_min_keycode = libxkbcommon.xkb_keymap_min_keycode
+xkb_keymap_min_keycode.argtypes = [POINTER(xkb_keymap)]
+xkb_keymap_min_keycode.restype = xkb_keycode_t
+
+xkb_keymap_max_keycode = libxkbcommon.xkb_keymap_max_keycode
+xkb_keymap_max_keycode.argtypes = [POINTER(xkb_keymap)]
+xkb_keymap_max_keycode.restype = xkb_keycode_t
+
+xkb_keymap_key_repeats = libxkbcommon.xkb_keymap_key_repeats
+xkb_keymap_key_repeats.argtypes = [POINTER(xkb_keymap), xkb_keycode_t]
+xkb_keymap_key_repeats.restype = c_int
+
+xkb_keymap_key_get_syms_by_level = libxkbcommon.xkb_keymap_key_get_syms_by_level
+xkb_keymap_key_get_syms_by_level.argtypes = [POINTER(xkb_keymap), xkb_keycode_t,
+                                             xkb_layout_index_t, xkb_level_index_t,
+                                             POINTER(POINTER(xkb_keysym_t))]
+xkb_keymap_key_get_syms_by_level.restype = c_int
+
+xkb_state_new = libxkbcommon.xkb_state_new
+xkb_state_new.argtypes = [POINTER(xkb_keymap)]
+xkb_state_new.restype = POINTER(xkb_state)
+
+xkb_state_unref = libxkbcommon.xkb_state_unref
+xkb_state_unref.argtypes = [POINTER(xkb_state)]
+xkb_state_unref.restype = None
+
+xkb_state_update_key = libxkbcommon.xkb_state_update_key
+xkb_state_update_key.argtypes = [POINTER(xkb_state), xkb_keycode_t, c_int]
+xkb_state_update_key.restype = c_int
+
+xkb_state_update_mask = libxkbcommon.xkb_state_update_mask
+xkb_state_update_mask.argtypes = [POINTER(xkb_state), xkb_mod_mask_t, xkb_mod_mask_t, xkb_mod_mask_t,
+                                  xkb_layout_index_t, xkb_layout_index_t, xkb_layout_index_t]
+xkb_state_update_mask.restype = c_int
+
+xkb_state_serialize_mods = libxkbcommon.xkb_state_serialize_mods
+xkb_state_serialize_mods.argtypes = [POINTER(xkb_state), c_int]
+xkb_state_serialize_mods.restype = xkb_mod_mask_t
+
+xkb_state_serialize_layout = libxkbcommon.xkb_state_serialize_layout
+xkb_state_serialize_layout.argtypes = [POINTER(xkb_state), c_int]
+xkb_state_serialize_layout.restype = xkb_layout_index_t
+
+xkb_state_key_get_one_sym = libxkbcommon.xkb_state_key_get_one_sym
+xkb_state_key_get_one_sym.argtypes = [POINTER(xkb_state), xkb_keycode_t]
+xkb_state_key_get_one_sym.restype = xkb_keysym_t
+
+xkb_state_key_get_utf8 = libxkbcommon.xkb_state_key_get_utf8
+xkb_state_key_get_utf8.argtypes = [POINTER(xkb_state), xkb_keycode_t, c_char_p, c_size_t]
+xkb_state_key_get_utf8.restype = c_int
+
+xkb_keysym_get_name = libxkbcommon.xkb_keysym_get_name
+xkb_keysym_get_name.argtypes = [xkb_keysym_t, c_char_p, c_size_t]
+xkb_keysym_get_name.restype = c_int
+
+xkb_compose_table_new_from_locale = libxkbcommon.xkb_compose_table_new_from_locale
+xkb_compose_table_new_from_locale.argtypes = [POINTER(xkb_context), c_char_p, c_int]
+xkb_compose_table_new_from_locale.restype = POINTER(xkb_compose_table)
+
+xkb_compose_table_unref = libxkbcommon.xkb_compose_table_unref
+xkb_compose_table_unref.argtypes = [POINTER(xkb_compose_table)]
+xkb_compose_table_unref.restype = None
+
+xkb_compose_state_new = libxkbcommon.xkb_compose_state_new
+xkb_compose_state_new.argtypes = [POINTER(xkb_compose_table), c_int]
+xkb_compose_state_new.restype = POINTER(xkb_compose_state)
+
+xkb_compose_state_unref = libxkbcommon.xkb_compose_state_unref
+xkb_compose_state_unref.argtypes = [POINTER(xkb_compose_state)]
+xkb_compose_state_unref.restype = None
+
+xkb_compose_state_feed = libxkbcommon.xkb_compose_state_feed
+xkb_compose_state_feed.argtypes = [POINTER(xkb_compose_state), xkb_keysym_t]
+xkb_compose_state_feed.restype = c_int
+
+xkb_compose_state_reset = libxkbcommon.xkb_compose_state_reset
+xkb_compose_state_reset.argtypes = [POINTER(xkb_compose_state)]
+xkb_compose_state_reset.restype = None
+
+xkb_compose_state_get_status = libxkbcommon.xkb_compose_state_get_status
+xkb_compose_state_get_status.argtypes = [POINTER(xkb_compose_state)]
+xkb_compose_state_get_status.restype = c_int
+
+xkb_compose_state_get_utf8 = libxkbcommon.xkb_compose_state_get_utf8
+xkb_compose_state_get_utf8.argtypes = [POINTER(xkb_compose_state), c_char_p, c_size_t]
+xkb_compose_state_get_utf8.restype = c_int
+
+xkb_compose_state_get_one_sym = libxkbcommon.xkb_compose_state_get_one_sym
+xkb_compose_state_get_one_sym.argtypes = [POINTER(xkb_compose_state)]
+xkb_compose_state_get_one_sym.restype = xkb_keysym_t
+
+
+## x11 support (optional, loaded on demand)
+XKB_X11_MIN_MAJOR_XKB_VERSION = 1
+XKB_X11_MIN_MINOR_XKB_VERSION = 0
+
+_libxkbcommon_x11 = None
+
+def _load_x11():
+    global _libxkbcommon_x11
+    if _libxkbcommon_x11 is None:
+        lib = CDLL('libxkbcommon-x11.so.0')
+        lib.xkb_x11_setup_xkb_extension.argtypes = [c_void_p, c_uint16, c_uint16, c_int,
+                                                    c_void_p, c_void_p, c_void_p, c_void_p]
+        lib.xkb_x11_setup_xkb_extension.restype = c_int
+        lib.xkb_x11_get_core_keyboard_device_id.argtypes = [c_void_p]
+        lib.xkb_x11_get_core_keyboard_device_id.restype = c_int32
+        lib.xkb_x11_keymap_new_from_device.argtypes = [POINTER(xkb_context), c_void_p, c_int32, c_int]
+        lib.xkb_x11_keymap_new_from_device.restype = POINTER(xkb_keymap)
+        lib.xkb_x11_state_new_from_device.argtypes = [POINTER(xkb_keymap), c_void_p, c_int32]
+        lib.xkb_x11_state_new_from_device.restype = POINTER(xkb_state)
+
+        libX11_xcb = CDLL('libX11-xcb.so.1')
+        libX11_xcb.XGetXCBConnection.argtypes = [c_void_p]
+        libX11_xcb.XGetXCBConnection.restype = c_void_p
+        lib.XGetXCBConnection = libX11_xcb.XGetXCBConnection
+        _libxkbcommon_x11 = lib
+    return _libxkbcommon_x11
+
+
+
+def keysym_name(keysym):
+    buf = create_string_buffer(64)
+    if xkb_keysym_get_name(keysym, buf, len(buf)) < 0:
+        return None
+    return buf.value
+
+
+class Translator():
+    def __init__(self, ctx, keymap, locale=None, state=None):
+        # takes ownership of the context, keymap and state
+        self.ctx = ctx
+        self.keymap = keymap
+        self.state = state or xkb_state_new(keymap)
+        if not self.state:
+            raise Exception("Cannot create keyboard state")
+
+        self.compose_table = None
+        self.compose = None
+        if locale:
+            table = xkb_compose_table_new_from_locale(ctx, locale.encode(), 0)
+            if table:
+                self.compose_table = table
+                self.compose = xkb_compose_state_new(table, 0)
+
+        self.buf = create_string_buffer(64)
+
+
+    @classmethod
+    def _new_context(cls):
+        ctx = xkb_context_new(0)
+        if not ctx:
+            raise Exception("Cannot create xkb context")
+        return ctx
+
+
+    @classmethod
+    def from_names(cls, layout=None, variant=None, model=None,
+                   options=None, rules=None, locale=None):
+        ctx = cls._new_context()
+        enc = lambda x: x.encode() if x is not None else None
+        names = xkb_rule_names(enc(rules), enc(model), enc(layout),
+                               enc(variant), enc(options))
+        keymap = xkb_keymap_new_from_names(ctx, byref(names), 0)
+        if not keymap:
+            xkb_context_unref(ctx)
+            raise Exception("Cannot compile keymap {}".format(layout))
+        return cls(ctx, keymap, locale)
+
+
+    @classmethod
+    def from_file(cls, path, locale=None):
+        with open(path, 'rb') as fd:
+            keymap_str = fd.read()
+        ctx = cls._new_context()
+        keymap = xkb_keymap_new_from_string(ctx, keymap_str, XKB_KEYMAP_FORMAT_TEXT_V1, 0)
+        if not keymap:
+            xkb_context_unref(ctx)
+            raise Exception("Cannot load keymap {}".format(path))
+        return cls(ctx, keymap, locale)
+
+
+    @classmethod
+    def from_x11(cls, dpy, locale=None):
+        # keymap of the core keyboard, fetched through the Xlib connection
+        lib = _load_x11()
+        conn = lib.XGetXCBConnection(dpy)
+        if not lib.xkb_x11_setup_xkb_extension(conn, XKB_X11_MIN_MAJOR_XKB_VERSION,
+                                               XKB_X11_MIN_MINOR_XKB_VERSION, 0,
+                                               None, None, None, None):
+            raise Exception("Cannot setup the XKB extension")
+        device_id = lib.xkb_x11_get_core_keyboard_device_id(conn)
+        if device_id < 0:
+            raise Exception("Cannot find the core keyboard")
+        ctx = cls._new_context()
+        keymap = lib.xkb_x11_keymap_new_from_device(ctx, conn, device_id, 0)
+        if not keymap:
+            xkb_context_unref(ctx)
+            raise Exception("Cannot fetch the server keymap")
+        # start from the current server state (locks included)
+        state = lib.xkb_x11_state_new_from_device(keymap, conn, device_id)
+        return cls(ctx, keymap, locale, state)
+
+
+    def close(self):
+        if self.compose:
+            xkb_compose_state_unref(self.compose)
+            xkb_compose_table_unref(self.compose_table)
+        xkb_state_unref(self.state)
+        xkb_keymap_unref(self.keymap)
+        xkb_context_unref(self.ctx)
+        self.state = self.keymap = self.ctx = None
+        self.compose = self.compose_table = None
+
+
+    def update_mask(self, state):
+        # set the modifier state from a core event state: the real modifiers
+        # share their bits with the xkb modifier indices
+        xkb_state_update_mask(self.state, state & 0xff, 0, 0, 0, 0, (state >> 13) & 3)
+
+
+    def update_key(self, keycode, pressed):
+        # track the modifier state from the key events themselves
+        xkb_state_update_key(self.state, keycode, XKB_KEY_DOWN if pressed else XKB_KEY_UP)
+
+
+    def mods_mask(self):
+        # effective state in core event format
+        mods = xkb_state_serialize_mods(self.state, XKB_STATE_MODS_EFFECTIVE)
+        group = xkb_state_serialize_layout(self.state, XKB_STATE_LAYOUT_EFFECTIVE)
+        return (mods & 0xff) | ((group & 3) << 13)
+
+
+    def modifier_keysyms(self):
+        # keysyms of the keys setting each of Mod1..Mod5, found by pressing
+        # each key on a scratch state; same layout as the server modifier
+        # mapping (first levels, then second levels, in key order)
+        keys = {}
+        for keycode in range(xkb_keymap_min_keycode(self.keymap),
+                             xkb_keymap_max_keycode(self.keymap) + 1):
+            state = xkb_state_new(self.keymap)
+            xkb_state_update_key(state, keycode, XKB_KEY_DOWN)
+            mods = xkb_state_serialize_mods(state, XKB_STATE_MODS_EFFECTIVE)
+            xkb_state_unref(state)
+            for mod in range(3, 8):
+                if mods & (1 << mod):
+                    keys.setdefault(1 << mod, []).append(keycode)
+        return {mask: [self.level_sym(keycode, level)
+                       for level in range(2) for keycode in keycodes]
+                for mask, keycodes in keys.items()}
+
+
+    def level_sym(self, keycode, level):
+        # keysym at the given level of the first layout
+        syms = POINTER(xkb_keysym_t)()
+        if xkb_keymap_key_get_syms_by_level(self.keymap, keycode, 0, level, byref(syms)) < 1:
+            return 0
+        return syms[0]
+
+
+    def key_repeats(self, keycode):
+        return bool(xkb_keymap_key_repeats(self.keymap, keycode))
+
+
+    def lookup(self, keycode):
+        return xkb_state_key_get_one_sym(self.state, keycode)
+
+
+    def _utf8(self, getter, *args):
+        ret = getter(*args, self.buf, len(self.buf))
+        if ret >= len(self.buf):
+            self.buf = create_string_buffer(ret + 1)
+            ret = getter(*args, self.buf, len(self.buf))
+        if ret <= 0:
+            return None
+        return self.buf.value.decode('utf-8', 'replace')
+
+
+    def translate(self, keycode, compose=True):
+        # return the keysym, the resulting string and whether the key was
+        # consumed by an ongoing composition
+        keysym = xkb_state_key_get_one_sym(self.state, keycode)
+        if compose and self.compose and \
+           xkb_compose_state_feed(self.compose, keysym) == XKB_COMPOSE_FEED_ACCEPTED:
+            status = xkb_compose_state_get_status(self.compose)
+            if status == XKB_COMPOSE_COMPOSING:
+                return keysym, None, True
+            elif status == XKB_COMPOSE_CANCELLED:
+                xkb_compose_state_reset(self.compose)
+                return keysym, None, True
+            elif status == XKB_COMPOSE_COMPOSED:
+                string = self._utf8(xkb_compose_state_get_utf8, self.compose)
+                keysym = xkb_compose_state_get_one_sym(self.compose) or keysym
+                xkb_compose_state_reset(self.compose)
+                return keysym, string, False
+        return keysym, self._utf8(xkb_state_key_get_utf8, self.state, keycode), False
+
+
+    def reset(self):
+        if self.compose:
+            xkb_compose_state_reset(self.compose)
+
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import os
+    import time
+
+    ap = ArgumentParser(description="translate X keycodes through libxkbcommon")
+    ap.add_argument('-l', '--layout', default='us', help="layout[:variant]")
+    ap.add_argument('-f', '--file', help="keymap file (overrides layout)")
+    ap.add_argument('--locale', default=os.environ.get('LANG', 'en_US.UTF-8'))
+    ap.add_argument('-n', '--repeat', type=int, default=1, help="repeat the sequence (timing)")
+    ap.add_argument('keycodes', nargs='+', help="[+|-]keycode")
+    args = ap.parse_args()
+
+    if args.file:
+        tr = Translator.from_file(args.file, args.locale)
+    else:
+        layout, _, variant = args.layout.partition(':')
+        tr = Translator.from_names(layout, variant or None, locale=args.locale)
+
+    seq = []
+    for code in args.keycodes:
+        if code[0] in '+-':
+            seq.append((int(code[1:]), code[0] == '+'))
+        else:
+            seq.extend([(int(code), True), (int(code), False)])
+
+    stamp = time.monotonic()
+    for i in range(args.repeat):
+        for keycode, pressed in seq:
+            if pressed:
+                keysym, string, filtered = tr.translate(keycode)
+                if i == 0:
+                    print(keycode, keysym_name(keysym), repr(string),
+                          "filtered" if filtered else "")
+            tr.update_key(keycode, pressed)
+    elapsed = time.monotonic() - stamp
+    if args.repeat > 1:
+        print("{:.2f}us/event".format(elapsed / (args.repeat * len(seq)) * 1000000))
+    tr.close()
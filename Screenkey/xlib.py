@@ -2,6 +2,7 @@
 # Copyright(c) 2015: wave++ "Yuri D'Elia" <wavexx@thregr.org>
 
 from ctypes import *
+import struct
 
 ## base X11
 libX11 = CDLL('libX11.so.6')
@@ -90,12 +91,69 @@ class XClientMessageEvent(Structure):
                 ('format', c_int),
                 ('data', c_long * 5)]
 
+class XPropertyEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('window', Window),
+                ('atom', Atom),
+                ('time', Time),
+                ('state', c_int)]
+
+class XFocusChangeEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('window', Window),
+                ('mode', c_int),
+                ('detail', c_int)]
+
+class XMappingEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('window', Window),
+                ('request', c_int),
+                ('first_keycode', c_int),
+                ('count', c_int)]
+
+class XkbAnyEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('time', Time),
+                ('xkb_type', c_int),
+                ('device', c_uint)]
+
+class XModifierKeymap(Structure):
+    _fields_ = [('max_keypermod', c_int),
+                ('modifiermap', POINTER(KeyCode))]
+
+class XGenericEventCookie(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('extension', c_int),
+                ('evtype', c_int),
+                ('cookie', c_uint),
+                ('data', c_void_p)]
+
 class XEvent(Union):
     _fields_ = [('type', c_int),
                 ('xkey', XKeyEvent),
                 ('xbutton', XButtonEvent),
                 ('xmotion', XMotionEvent),
+                ('xfocus', XFocusChangeEvent),
+                ('xproperty', XPropertyEvent),
                 ('xclient', XClientMessageEvent),
+                ('xmapping', XMappingEvent),
+                ('xkb', XkbAnyEvent),
+                ('xcookie', XGenericEventCookie),
                 ('pad', c_long * 24)]
 
 class XSetWindowAttributes(Structure):
@@ -124,13 +182,33 @@ ButtonRelease = 5
 MotionNotify = 6
 FocusIn = 9
 FocusOut = 10
+PropertyNotify = 28
 ClientMessage = 33
+MappingNotify = 34
+GenericEvent = 35
+
+NotifyAncestor = 0
+NotifyVirtual = 1
+NotifyInferior = 2
+NotifyNonlinear = 3
+NotifyNonlinearVirtual = 4
+NotifyPointer = 5
 
 CopyFromParent = 0
 InputOnly = 2
 
+QueuedAlready = 0
+QueuedAfterReading = 1
+QueuedAfterFlush = 2
+
 CWOverrideRedirect = (1<<9)
 
+MappingModifier = 0
+MappingKeyboard = 1
+MappingPointer = 2
+
+PropertyChangeMask = (1<<22)
+
 ShiftMask = (1<<0)
 LockMask = (1<<1)
 ControlMask = (1<<2)
@@ -194,6 +272,30 @@ XPending = libX11.XPending
 XPending.argtypes = [POINTER(Display)]
 XPending.restype = c_int
 
+XEventsQueued = libX11.XEventsQueued
+XEventsQueued.argtypes = [POINTER(Display), c_int]
+XEventsQueued.restype = c_int
+
+XQueryKeymap = libX11.XQueryKeymap
+XQueryKeymap.argtypes = [POINTER(Display), c_char * 32]
+XQueryKeymap.restype = c_int
+
+XSelectInput = libX11.XSelectInput
+XSelectInput.argtypes = [POINTER(Display), Window, c_long]
+XSelectInput.restype = c_int
+
+XQueryExtension = libX11.XQueryExtension
+XQueryExtension.argtypes = [POINTER(Display), String, POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+XQueryExtension.restype = Bool
+
+XGetEventData = libX11.XGetEventData
+XGetEventData.argtypes = [POINTER(Display), POINTER(XGenericEventCookie)]
+XGetEventData.restype = Bool
+
+XFreeEventData = libX11.XFreeEventData
+XFreeEventData.argtypes = [POINTER(Display), POINTER(XGenericEventCookie)]
+XFreeEventData.restype = None
+
 XSynchronize = libX11.XSynchronize
 XSynchronize.argtypes = [POINTER(Display), c_int]
 XSynchronize.restype = POINTER(CFUNCTYPE(c_int, POINTER(Display)))
@@ -216,11 +318,42 @@ class _XrmDatabase(Structure):
 
 XrmDatabase = POINTER(_XrmDatabase)
 
+# the XIC is passed as a plain address to the callbacks
+XIMProc = CFUNCTYPE(None, c_void_p, c_void_p, c_void_p)
+XICProc = CFUNCTYPE(c_int, c_void_p, c_void_p, c_void_p)
+
+class XIMCallback(Structure):
+    _fields_ = [('client_data', c_void_p),
+                ('callback', c_void_p)]
+
+class XIMText(Structure):
+    _fields_ = [('length', c_ushort),
+                ('feedback', POINTER(c_ulong)),
+                ('encoding_is_wchar', Bool),
+                ('string', c_void_p)]
+
+class XIMPreeditDrawCallbackStruct(Structure):
+    _fields_ = [('caret', c_int),
+                ('chg_first', c_int),
+                ('chg_length', c_int),
+                ('text', POINTER(XIMText))]
+
+class XIMPreeditCaretCallbackStruct(Structure):
+    _fields_ = [('position', c_int),
+                ('direction', c_int),
+                ('style', c_int)]
+
 
 # constants
 XNInputStyle = b'inputStyle'
 XNClientWindow = b'clientWindow'
+XNPreeditAttributes = b'preeditAttributes'
+XNPreeditStartCallback = b'preeditStartCallback'
+XNPreeditDoneCallback = b'preeditDoneCallback'
+XNPreeditDrawCallback = b'preeditDrawCallback'
+XNPreeditCaretCallback = b'preeditCaretCallback'
 
+XIMPreeditCallbacks = 0x0002
 XIMPreeditNothing = 0x0008
 XIMPreeditNone = 0x0010
 XIMStatusNothing = 0x0400
@@ -258,9 +391,16 @@ XSetICFocus = libX11.XSetICFocus
 XSetICFocus.argtypes = [XIC]
 XSetICFocus.restype = None
 
+XVaCreateNestedList = libX11.XVaCreateNestedList
+XVaCreateNestedList.restype = c_void_p
+
+XUnsetICFocus = libX11.XUnsetICFocus
+XUnsetICFocus.argtypes = [XIC]
+XUnsetICFocus.restype = None
+
 Xutf8ResetIC = libX11.Xutf8ResetIC
 Xutf8ResetIC.argtypes = [XIC]
-Xutf8ResetIC.restype = String
+Xutf8ResetIC.restype = c_void_p
 
 Xutf8LookupString = libX11.Xutf8LookupString
 Xutf8LookupString.argtypes = [XIC, POINTER(XKeyPressedEvent), String, c_int, POINTER(KeySym), POINTER(c_int)]
@@ -270,10 +410,53 @@ XKeysymToString = libX11.XKeysymToString
 XKeysymToString.argtypes = [KeySym]
 XKeysymToString.restype = String
 
+XStringToKeysym = libX11.XStringToKeysym
+XStringToKeysym.argtypes = [String]
+XStringToKeysym.restype = KeySym
+
+XLookupString = libX11.XLookupString
+XLookupString.argtypes = [POINTER(XKeyEvent), String, c_int, POINTER(KeySym), c_void_p]
+XLookupString.restype = c_int
+
 XkbKeycodeToKeysym = libX11.XkbKeycodeToKeysym
 XkbKeycodeToKeysym.argtypes = [POINTER(Display), KeyCode, c_uint, c_uint]
 XkbKeycodeToKeysym.restype = KeySym
 
+XGetModifierMapping = libX11.XGetModifierMapping
+XGetModifierMapping.argtypes = [POINTER(Display)]
+XGetModifierMapping.restype = POINTER(XModifierKeymap)
+
+XFreeModifiermap = libX11.XFreeModifiermap
+XFreeModifiermap.argtypes = [POINTER(XModifierKeymap)]
+XFreeModifiermap.restype = c_int
+
+XRefreshKeyboardMapping = libX11.XRefreshKeyboardMapping
+XRefreshKeyboardMapping.argtypes = [POINTER(XEvent)]
+XRefreshKeyboardMapping.restype = c_int
+
+
+## xkb
+XkbUseCoreKbd = 0x0100
+
+XkbNewKeyboardNotify = 0
+XkbMapNotify = 1
+
+XkbNewKeyboardNotifyMask = (1<<0)
+XkbMapNotifyMask = (1<<1)
+
+XkbQueryExtension = libX11.XkbQueryExtension
+XkbQueryExtension.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int),
+                              POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+XkbQueryExtension.restype = Bool
+
+XkbSelectEvents = libX11.XkbSelectEvents
+XkbSelectEvents.argtypes = [POINTER(Display), c_uint, c_ulong, c_ulong]
+XkbSelectEvents.restype = Bool
+
+XkbRefreshKeyboardMapping = libX11.XkbRefreshKeyboardMapping
+XkbRefreshKeyboardMapping.argtypes = [POINTER(XEvent)]
+XkbRefreshKeyboardMapping.restype = Status
+
 
 ## record extensions
 libXtst = CDLL('libXtst.so.6')
@@ -352,6 +535,92 @@ XRecordFreeData.argtypes = [POINTER(XRecordInterceptData)]
 XRecordFreeData.restype = None
 
 
+## xinput2
+# types
+class XIEventMask(Structure):
+    _fields_ = [('deviceid', c_int),
+                ('mask_len', c_int),
+                ('mask', POINTER(c_ubyte))]
+
+class XIValuatorState(Structure):
+    _fields_ = [('mask_len', c_int),
+                ('mask', POINTER(c_ubyte)),
+                ('values', POINTER(c_double))]
+
+class XIRawEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('extension', c_int),
+                ('evtype', c_int),
+                ('time', Time),
+                ('deviceid', c_int),
+                ('sourceid', c_int),
+                ('detail', c_int),
+                ('flags', c_int),
+                ('valuators', XIValuatorState),
+                ('raw_values', POINTER(c_double))]
+
+class XIDeviceInfo(Structure):
+    _fields_ = [('deviceid', c_int),
+                ('name', String),
+                ('use', c_int),
+                ('attachment', c_int),
+                ('enabled', Bool),
+                ('num_classes', c_int),
+                ('classes', c_void_p)]
+
+
+# constants
+XIAllDevices = 0
+XIAllMasterDevices = 1
+
+XI_HierarchyChanged = 11
+XI_RawKeyPress = 13
+XI_RawKeyRelease = 14
+XI_RawButtonPress = 15
+XI_RawButtonRelease = 16
+XI_RawMotion = 17
+XI_LASTEVENT = XI_RawMotion
+
+XIMasterKeyboard = 3
+XISlaveKeyboard = 4
+XISlavePointer = 2
+XIMasterPointer = 1
+
+XIKeyRepeat = (1<<16)
+
+
+# functions: libXi is only required for XInput2 capture, load it on demand
+_libXi = None
+
+def load_xi():
+    global _libXi
+    if _libXi is None:
+        try:
+            lib = CDLL('libXi.so.6')
+        except OSError:
+            raise Exception("XInput2 capture requires libXi (libXi.so.6)")
+        lib.XIQueryVersion.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int)]
+        lib.XIQueryVersion.restype = Status
+        lib.XISelectEvents.argtypes = [POINTER(Display), Window, POINTER(XIEventMask), c_int]
+        lib.XISelectEvents.restype = Status
+        lib.XIQueryDevice.argtypes = [POINTER(Display), c_int, POINTER(c_int)]
+        lib.XIQueryDevice.restype = POINTER(XIDeviceInfo)
+        lib.XIFreeDeviceInfo.argtypes = [POINTER(XIDeviceInfo)]
+        lib.XIFreeDeviceInfo.restype = None
+        _libXi = lib
+    return _libXi
+
+
+def XIMask(*evtypes):
+    mask = (c_ubyte * ((XI_LASTEVENT >> 3) + 1))()
+    for evtype in evtypes:
+        mask[evtype >> 3] |= 1 << (evtype & 7)
+    return mask
+
+
 ## wire protocol
 CARD8 = c_ubyte
 CARD16 = c_ushort
@@ -384,73 +653,52 @@ class xEvent(Union):
                 ('keyButtonPointer', xKeyButtonPointer)]
 
 
-def _kbd_wire_to_event(dpy, wev):
-    ev = XEvent()
-    ev.xkey.type = wev.u.type
-    ev.xkey.serial = wev.u.sequenceNumber
-    ev.xkey.send_event = ((wev.u.type & 0x80) != 0)
-    ev.xkey.display = dpy
-    ev.xkey.window = wev.keyButtonPointer.event
-    ev.xkey.root = wev.keyButtonPointer.root
-    ev.xkey.subwindow = wev.keyButtonPointer.child
-    ev.xkey.time = wev.keyButtonPointer.time
-    ev.xkey.x = wev.keyButtonPointer.eventX
-    ev.xkey.y = wev.keyButtonPointer.eventY
-    ev.xkey.x_root = wev.keyButtonPointer.rootX
-    ev.xkey.y_root = wev.keyButtonPointer.rootY
-    ev.xkey.state = wev.keyButtonPointer.state
-    ev.xkey.keycode = wev.u.detail
-    ev.xkey.same_screen = wev.keyButtonPointer.sameScreen
-    return ev
+# Only the fields used by screenkey are decoded, straight from the record
+# buffer: type, detail, sequenceNumber, time, root, rootX, rootY, state and
+# sameScreen (event, child, eventX and eventY are skipped).
+xEventFields = struct.Struct('=BBHII8xhh4xHB')
+xEventBuffer = c_ubyte * xEventFields.size
 
-
-def _btn_wire_to_event(dpy, wev):
-    ev = XEvent()
-    ev.xbutton.type = wev.u.type
-    ev.xbutton.serial = wev.u.sequenceNumber
-    ev.xbutton.send_event = ((wev.u.type & 0x80) != 0)
-    ev.xbutton.display = dpy
-    ev.xbutton.window = wev.keyButtonPointer.event
-    ev.xbutton.root = wev.keyButtonPointer.root
-    ev.xbutton.subwindow = wev.keyButtonPointer.child
-    ev.xbutton.time = wev.keyButtonPointer.time
-    ev.xbutton.x = wev.keyButtonPointer.eventX
-    ev.xbutton.y = wev.keyButtonPointer.eventY
-    ev.xbutton.x_root = wev.keyButtonPointer.rootX
-    ev.xbutton.y_root = wev.keyButtonPointer.rootY
-    ev.xbutton.state = wev.keyButtonPointer.state
-    ev.xbutton.button = wev.u.detail
-    ev.xbutton.same_screen = wev.keyButtonPointer.sameScreen
-    return ev
+# focus events: type, detail, sequenceNumber, window and mode
+xFocusFields = struct.Struct('=BBHIB')
 
 
-def _mtn_wire_to_event(dpy, wev):
-    ev = XEvent()
-    ev.xmotion.type = wev.u.type
-    ev.xmotion.serial = wev.u.sequenceNumber
-    ev.xmotion.send_event = ((wev.u.type & 0x80) != 0)
-    ev.xmotion.display = dpy
-    ev.xmotion.window = wev.keyButtonPointer.event
-    ev.xmotion.root = wev.keyButtonPointer.root
-    ev.xmotion.subwindow = wev.keyButtonPointer.child
-    ev.xmotion.time = wev.keyButtonPointer.time
-    ev.xmotion.x = wev.keyButtonPointer.eventX
-    ev.xmotion.y = wev.keyButtonPointer.eventY
-    ev.xmotion.x_root = wev.keyButtonPointer.rootX
-    ev.xmotion.y_root = wev.keyButtonPointer.rootY
-    ev.xmotion.state = wev.keyButtonPointer.state
-    ev.xmotion.is_hint = wev.u.detail
-    ev.xmotion.same_screen = wev.keyButtonPointer.sameScreen
-    return ev
+def XWireDecode(data):
+    # view the record data in place, without copying it
+    return xEventFields.unpack_from(xEventBuffer.from_address(addressof(data.contents)))
 
 
-def XWireToEvent(dpy, data):
+def XWireToEvent(dpy, data, ev=None):
     # this could have been avoided if _XWireToEvent didn't have internal state
-    wev = cast(data, POINTER(xEvent)).contents
-    if wev.u.type in [KeyPress, KeyRelease]:
-        return _kbd_wire_to_event(dpy, wev)
-    elif wev.u.type in [ButtonPress, ButtonRelease]:
-        return _btn_wire_to_event(dpy, wev)
-    elif wev.u.type == MotionNotify:
-        return _mtn_wire_to_event(dpy, wev)
-    return XEvent(wev.u.type)
+    # ev can be passed to reuse the same buffer across calls
+    if ev is None:
+        ev = XEvent()
+    type, detail, serial, time, root, x_root, y_root, state, same_screen = XWireDecode(data)
+    ev.type = type
+    if type in (KeyPress, KeyRelease, ButtonPress, ButtonRelease, MotionNotify):
+        # key, button and motion events share the same layout
+        kev = ev.xkey
+        kev.serial = serial
+        kev.send_event = False
+        kev.display = dpy
+        kev.root = root
+        kev.time = time
+        kev.x_root = x_root
+        kev.y_root = y_root
+        kev.state = state
+        kev.same_screen = same_screen
+        if type == MotionNotify:
+            ev.xmotion.is_hint = detail
+        else:
+            kev.keycode = detail
+    elif type in (FocusIn, FocusOut):
+        _, _, _, window, mode = xFocusFields.unpack_from(
+            xEventBuffer.from_address(addressof(data.contents)))
+        fev = ev.xfocus
+        fev.serial = serial
+        fev.send_event = False
+        fev.display = dpy
+        fev.window = window
+        fev.mode = mode
+        fev.detail = detail
+    return ev